@@ -0,0 +1,104 @@
+import numpy as np
+
+## Below this fraction of set bits, a bitmap stores its set positions
+## (4 bytes each) rather than packed bits (1/8 byte per row)
+SPARSE_FRACTION = 1 / 32
+
+
+class Bitmap:
+    """
+    Compressed set of row positions in a table of a given length, used as a
+    boolean index. Sparse sets are stored as sorted int32 positions and dense
+    sets as packed bits (8 rows per byte), whichever is smaller. Supports AND
+    (intersect) and ANDNOT (difference), and adding positions in place.
+    """
+
+    def __init__(self, length, words=None, positions=None):
+        self.length = length
+        self.words = words
+        self.positions = positions
+
+    @classmethod
+    def from_bool(cls, bool_array):
+        bool_array = np.asarray(bool_array, dtype=bool)
+        length = len(bool_array)
+        if np.count_nonzero(bool_array) < length * SPARSE_FRACTION:
+            return cls(length, positions=np.flatnonzero(bool_array).astype(np.int32))
+        return cls(length, words=np.packbits(bool_array, bitorder="little"))
+
+    @classmethod
+    def empty(cls, length):
+        """
+        Dense bitmap with no bits set, for state that is added to in place.
+        """
+        return cls(length, words=np.zeros((length + 7) // 8, dtype=np.uint8))
+
+    @classmethod
+    def full(cls, length):
+        return cls.from_bool(np.ones(length, dtype=bool))
+
+    @property
+    def is_sparse(self):
+        return self.positions is not None
+
+    @property
+    def nbytes(self):
+        return self.positions.nbytes if self.is_sparse else self.words.nbytes
+
+    def cardinality(self):
+        if self.is_sparse:
+            return len(self.positions)
+        return int(
+            np.unpackbits(self.words, count=self.length, bitorder="little").sum()
+        )
+
+    def contains(self, positions):
+        """
+        Returns a boolean array of whether each of the given positions is set.
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        if self.is_sparse:
+            if len(self.positions) == 0:
+                return np.zeros(len(positions), dtype=bool)
+            found = np.searchsorted(self.positions, positions)
+            found[found == len(self.positions)] = 0
+            return self.positions[found] == positions
+        return ((self.words[positions >> 3] >> (positions & 7)) & 1).astype(bool)
+
+    def add(self, positions):
+        """
+        Sets the bits at the given positions in place. Only for dense bitmaps.
+        """
+        assert not self.is_sparse, "Can only add to a dense bitmap"
+        positions = np.asarray(positions, dtype=np.int64)
+        bits = np.left_shift(1, positions & 7).astype(np.uint8)
+        np.bitwise_or.at(self.words, positions >> 3, bits)
+
+    def intersect(self, other):
+        if self.is_sparse:
+            return Bitmap(
+                self.length, positions=self.positions[other.contains(self.positions)]
+            )
+        if other.is_sparse:
+            return other.intersect(self)
+        return Bitmap(self.length, words=self.words & other.words)
+
+    def difference(self, other):
+        if self.is_sparse:
+            return Bitmap(
+                self.length, positions=self.positions[~other.contains(self.positions)]
+            )
+        if other.is_sparse:
+            removed = Bitmap.empty(self.length)
+            removed.add(other.positions)
+            return Bitmap(self.length, words=self.words & ~removed.words)
+        return Bitmap(self.length, words=self.words & ~other.words)
+
+    def to_bool(self):
+        if self.is_sparse:
+            bool_array = np.zeros(self.length, dtype=bool)
+            bool_array[self.positions] = True
+            return bool_array
+        return np.unpackbits(self.words, count=self.length, bitorder="little").view(
+            bool
+        )
@@ -0,0 +1,165 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+## Match count of a case that has not been matched yet
+NOT_PROCESSED = -1
+
+
+def get_fingerprint(options, arrays):
+    """
+    Returns the sha256 hex digest of the matching options and of the arrays
+    that are matched on, so that a checkpoint is only resumed with the same
+    inputs. The arrays are a dict of NumPy arrays, hashed in key order.
+    """
+    fingerprint = hashlib.sha256(
+        json.dumps(options, sort_keys=True, default=str).encode()
+    )
+    for key in sorted(arrays):
+        values = np.ascontiguousarray(arrays[key])
+        fingerprint.update(f"{key}:{values.dtype.str}:{values.shape}".encode())
+        fingerprint.update(values.data)
+    return fingerprint.hexdigest()
+
+
+def save_checkpoint(checkpoint_path, fingerprint, picked):
+    """
+    Saves the matches picked so far, a list in case order with the positions
+    picked for each case or None for cases not yet matched, to
+    checkpoint_path as a compressed .npz file. It is written to a temporary
+    file first, so an interrupted save leaves the previous checkpoint intact.
+    """
+    counts = np.array(
+        [
+            NOT_PROCESSED if positions is None else len(positions)
+            for positions in picked
+        ],
+        dtype=np.int64,
+    )
+    positions = np.concatenate(
+        [positions for positions in picked if positions is not None]
+        + [np.zeros(0, dtype=np.int64)]
+    ).astype(np.int64)
+    temp_path = f"{checkpoint_path}.tmp{os.getpid()}.npz"
+    np.savez_compressed(
+        temp_path, fingerprint=np.array(fingerprint), counts=counts, positions=positions
+    )
+    os.replace(temp_path, checkpoint_path)
+
+
+def load_checkpoint(checkpoint_path, fingerprint, num_cases):
+    """
+    Loads a checkpoint saved by save_checkpoint, returning the list of picked
+    positions (None for cases not yet matched). Returns None if there is no
+    checkpoint, and raises an exception if it was saved for different inputs.
+    """
+    if not os.path.isfile(checkpoint_path):
+        return None
+    with np.load(checkpoint_path) as checkpoint:
+        if (
+            str(checkpoint["fingerprint"]) != fingerprint
+            or len(checkpoint["counts"]) != num_cases
+        ):
+            raise Exception(
+                f"Checkpoint {checkpoint_path} was saved for different inputs or "
+                "options, so it cannot be resumed"
+            )
+        counts = checkpoint["counts"]
+        positions = checkpoint["positions"]
+    bounds = np.cumsum(np.maximum(counts, 0))
+    picked = []
+    for count, end in zip(counts, bounds):
+        if count == NOT_PROCESSED:
+            picked.append(None)
+        else:
+            picked.append(positions[end - count : end])
+    return picked
+
+
+def get_partition_fingerprints(
+    options, case_ids, case_pool, match_ids, match_pool, partitions, case_order
+):
+    """
+    Returns the sha256 hex digest of the inputs of each partition that has
+    cases, keyed on its partition code: the matching options, and the ids and
+    encoded values of its cases (in case_order, the order they are matched
+    in) and of its matches (in the partition's order). Partitions never share
+    matches, so one whose fingerprint is unchanged is matched in the same way.
+    The partition codes themselves are left out, as they change whenever a
+    value of an exact match variable is added or removed.
+    """
+    options_hash = hashlib.sha256(
+        json.dumps(options, sort_keys=True, default=str).encode()
+    )
+    case_keys = case_pool["partition"][case_order]
+    order = case_order[np.argsort(case_keys, kind="stable")]
+    starts = np.flatnonzero(np.diff(case_pool["partition"][order], prepend=-2) != 0)
+    fingerprints = {}
+    for case_positions in np.split(order, starts[1:]):
+        if len(case_positions) == 0:
+            continue
+        key = case_pool["partition"][case_positions[0]]
+        positions = partitions.get(key, np.zeros(0, dtype=np.int64))
+        fingerprint = options_hash.copy()
+        for name, ids, pool, rows in (
+            ("case", case_ids, case_pool, case_positions),
+            ("match", match_ids, match_pool, positions),
+        ):
+            arrays = {
+                "id": ids,
+                **{var: pool[var] for var in pool if var != "partition"},
+            }
+            for var in sorted(arrays):
+                values = np.ascontiguousarray(np.asarray(arrays[var])[rows])
+                fingerprint.update(
+                    f"{name}:{var}:{values.dtype.str}:{len(values)}".encode()
+                )
+                fingerprint.update(values.data)
+        fingerprints[key] = fingerprint.hexdigest()
+    return fingerprints
+
+
+def save_matching_state(state_path, case_ids, case_fingerprints, picked_ids):
+    """
+    Saves the result of a matching, for incremental matching: the id of each
+    case, the fingerprint of its partition from get_partition_fingerprints,
+    and the ids of the matches it picked. Written via a temporary file, as by
+    save_checkpoint.
+    """
+    counts = np.array([len(ids) for ids in picked_ids], dtype=np.int64)
+    temp_path = f"{state_path}.tmp{os.getpid()}.npz"
+    np.savez_compressed(
+        temp_path,
+        case_ids=np.asarray(case_ids),
+        case_fingerprints=np.asarray(case_fingerprints, dtype="U64"),
+        counts=counts,
+        match_ids=np.concatenate(
+            [np.asarray(ids) for ids in picked_ids] + [np.zeros(0, dtype=np.int64)]
+        ),
+    )
+    os.replace(temp_path, state_path)
+
+
+def load_matching_state(state_path):
+    """
+    Loads a state saved by save_matching_state as a dict mapping each
+    partition fingerprint to a dict of the ids of the matches picked by each
+    of its cases. Returns an empty dict if there is no saved state.
+    """
+    if not os.path.isfile(state_path):
+        return {}
+    with np.load(state_path, allow_pickle=False) as state:
+        case_ids = state["case_ids"]
+        case_fingerprints = state["case_fingerprints"]
+        counts = state["counts"]
+        match_ids = state["match_ids"]
+    bounds = np.cumsum(counts)
+    previous = {}
+    for case_id, fingerprint, count, end in zip(
+        case_ids, case_fingerprints, counts, bounds
+    ):
+        previous.setdefault(str(fingerprint), {})[case_id] = match_ids[
+            end - count : end
+        ]
+    return previous
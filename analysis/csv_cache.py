@@ -0,0 +1,165 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+## Bytes read at a time when hashing a csv
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def hash_file(path):
+    """
+    Returns the sha256 hex digest of a file's contents.
+    """
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def hash_options(read_csv_kwargs):
+    """
+    Returns a short hash of the options used to read a csv, together with the
+    pandas version, as both change the columns and dtypes that are read.
+    """
+    options = json.dumps(
+        {"pandas": pd.__version__, **read_csv_kwargs}, sort_keys=True, default=str
+    )
+    return hashlib.sha256(options.encode()).hexdigest()[:16]
+
+
+def save_columns(df, cache_dir):
+    """
+    Saves each column of df, and its index, as a .npy file in cache_dir, with a
+    columns.json listing them. Object (string) and categorical columns are
+    saved as integer codes plus their unique values, and nullable integer
+    columns as their values plus a mask of the missing ones.
+    """
+    os.makedirs(cache_dir)
+    manifest = {"columns": []}
+    all_columns = [(df.index.name, df.index)] + list(df.items())
+    for number, (name, column) in enumerate(all_columns):
+        if isinstance(column.dtype, pd.CategoricalDtype) or column.dtype == object:
+            if isinstance(column.dtype, pd.CategoricalDtype):
+                codes = column.cat.codes.to_numpy()
+                uniques = column.cat.categories
+                kind = "category"
+            else:
+                codes, uniques = pd.factorize(column)
+                kind = "object"
+            np.save(os.path.join(cache_dir, f"{number}.npy"), codes)
+            np.save(
+                os.path.join(cache_dir, f"{number}_values.npy"),
+                np.asarray(uniques, dtype=object),
+                allow_pickle=True,
+            )
+        elif pd.api.types.is_extension_array_dtype(
+            column.dtype
+        ) and pd.api.types.is_integer_dtype(column.dtype):
+            np.save(
+                os.path.join(cache_dir, f"{number}.npy"),
+                column.to_numpy(dtype=column.dtype.numpy_dtype, na_value=0),
+            )
+            np.save(
+                os.path.join(cache_dir, f"{number}_mask.npy"),
+                column.isna().to_numpy(),
+            )
+            kind = "masked"
+        else:
+            values = np.asarray(column)
+            np.save(os.path.join(cache_dir, f"{number}.npy"), values)
+            kind = "array"
+        manifest["columns"].append({"name": name, "kind": kind})
+    with open(os.path.join(cache_dir, "columns.json"), "w") as f:
+        json.dump(manifest, f)
+
+
+def load_columns(cache_dir):
+    """
+    Loads a table saved by save_columns.
+    """
+    with open(os.path.join(cache_dir, "columns.json")) as f:
+        manifest = json.load(f)
+    columns = {}
+    for number, column in enumerate(manifest["columns"]):
+        values = np.load(os.path.join(cache_dir, f"{number}.npy"))
+        if column["kind"] in ("object", "category"):
+            uniques = np.load(
+                os.path.join(cache_dir, f"{number}_values.npy"), allow_pickle=True
+            )
+            values = pd.Categorical.from_codes(values, uniques)
+            if column["kind"] == "object":
+                values = np.asarray(values, dtype=object)
+        elif column["kind"] == "masked":
+            values = pd.arrays.IntegerArray(
+                values, np.load(os.path.join(cache_dir, f"{number}_mask.npy"))
+            )
+        columns[number] = (column["name"], values)
+    index_name, index_values = columns.pop(0)
+    df = pd.DataFrame(
+        {name: values for name, values in columns.values()},
+        index=pd.Index(index_values, name=index_name),
+    )
+    return df
+
+
+def save_keyed_dir(target_dir, prefix, source_path, save):
+    """
+    Saves a directory that is keyed on the contents of source_path, and named
+    prefix followed by their hash, such as a cache of it. save is called with
+    a temporary directory, which is then renamed to target_dir, so a partly
+    written directory is never read. If several runs save the same directory
+    at once, the first to rename it wins. Then removes the directories of
+    earlier versions of source_path with the same prefix: those saved before
+    source_path was last changed. target_dir and the temporary directories of
+    other runs are never removed, so runs can share the parent directory.
+    """
+    parent = os.path.dirname(target_dir)
+    os.makedirs(parent, exist_ok=True)
+    temp_dir = f"{target_dir}.tmp{os.getpid()}"
+    save(temp_dir)
+    try:
+        os.replace(temp_dir, target_dir)
+    except OSError:
+        ## Another run saved the same directory first
+        shutil.rmtree(temp_dir)
+
+    source_changed = os.path.getmtime(source_path)
+    for name in os.listdir(parent):
+        path = os.path.join(parent, name)
+        if not name.startswith(prefix) or ".tmp" in name or path == target_dir:
+            continue
+        try:
+            earlier = os.path.getmtime(path) < source_changed
+        except FileNotFoundError:
+            ## Removed by another run
+            continue
+        if earlier:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def read_csv_cached(csv_path, cache_path=None, **read_csv_kwargs):
+    """
+    Equivalent of pd.read_csv(csv_path, **read_csv_kwargs), which must set an
+    index_col. If cache_path is given, the table is saved there as columnar
+    .npy files the first time, and loaded from them on later calls. The cache
+    is keyed on the csv's contents and the read options, so it is not used
+    (and is replaced) if either changes.
+    """
+    if cache_path is None:
+        return pd.read_csv(csv_path, **read_csv_kwargs)
+
+    stem = os.path.splitext(os.path.basename(csv_path))[0]
+    prefix = f"{stem}-{hash_options(read_csv_kwargs)}-"
+    cache_dir = os.path.join(cache_path, prefix + hash_file(csv_path))
+    if os.path.isdir(cache_dir):
+        return load_columns(cache_dir)
+
+    df = pd.read_csv(csv_path, **read_csv_kwargs)
+    save_keyed_dir(
+        cache_dir, prefix, csv_path, lambda temp_dir: save_columns(df, temp_dir)
+    )
+    return df
@@ -1,65 +1,399 @@
 import os
 import copy
+import json
+import inspect
+import time
 import random
-from datetime import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import numpy as np
 import pandas as pd
 
+from bitmaps import Bitmap
+from csv_cache import read_csv_cached, hash_file, hash_options, save_keyed_dir
+from checkpoints import (
+    get_fingerprint,
+    save_checkpoint,
+    load_checkpoint,
+    get_partition_fingerprints,
+    save_matching_state,
+    load_matching_state,
+)
+from progress import PhaseTimer, ProgressReporter
+from profiling import Profiler, profile_section
+from outputs import write_matched_outputs
+from study_schema import (
+    get_schema,
+    get_schema_dtypes,
+    set_schema_types,
+    get_month_categories,
+)
+
 NOT_PREVIOUSLY_MATCHED = -9
+MISSING_DATE = np.iinfo(np.int32).min
+## In place of the earliest "before" exclusion date of matches that have none
+NO_BEFORE_DATE = np.iinfo(np.int32).max
+## Changed whenever the arrays saved in a shared match pool change, so that
+## pools saved by older versions are rebuilt
+SHARED_POOL_VERSION = 2
+## Seed of the randomise variable when no random_seed is given
+LEGACY_RANDOM_SEED = 999
+## Values read at a time when reading rows back from a csv
+READ_BACK_CELLS = 2000000
 
+## Options of match() that decide what is imported and how it is indexed, so
+## must be the same for all the configurations of match_many
+POPULATION_OPTIONS = (
+    "case_csv",
+    "match_csv",
+    "index_date_variable",
+    "closest_match_variables",
+    "date_exclusion_variables",
+    "replace_match_index_date_with_case",
+    "indicator_variable_name",
+    "output_path",
+    "engine",
+    "import_columns",
+    "date_format",
+    "cache_path",
+    "pool_path",
+    "schema",
+)
 
-def import_csvs(
-    case_csv,
-    match_csv,
+
+def get_csv_engine():
+    """
+    Returns the fastest pandas CSV parser engine that is installed.
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return "c"
+    return "pyarrow"
+
+
+def get_matching_columns(
     match_variables,
     date_exclusion_variables,
     index_date_variable,
-    output_path,
-    replace_match_index_date_with_case=None,
+    closest_match_variables=None,
 ):
     """
-    Imports the two csvs specified under case_csv and match_csv.
-    Also sets the correct data types for the matching variables.
+    Returns the columns needed to do the matching, which of them are numeric,
+    ie match variables with an integer tolerance and closest_match_variables,
+    and which are dates, ie the index date, date exclusion variables and
+    month_only match variables.
     """
-    cases = pd.read_csv(
-        os.path.join(output_path, f"{case_csv}.csv"),
-        index_col="patient_id",
-    )
-    matches = pd.read_csv(
-        os.path.join(output_path, f"{match_csv}.csv"),
+    columns = [index_date_variable]
+    numeric_columns = []
+    date_columns = [index_date_variable]
+    for var, match_type in match_variables.items():
+        columns.append(var)
+        if isinstance(match_type, int):
+            numeric_columns.append(var)
+        elif match_type == "month_only":
+            date_columns.append(var)
+    if closest_match_variables is not None:
+        columns.extend(closest_match_variables)
+        numeric_columns.extend(closest_match_variables)
+    if date_exclusion_variables is not None:
+        columns.extend(date_exclusion_variables)
+        date_columns.extend(date_exclusion_variables)
+    return list(dict.fromkeys(columns)), numeric_columns, date_columns
+
+
+def get_date_text(values):
+    """
+    Returns a column of dates that the pyarrow engine has parsed into
+    datetime.date objects as their YYYY-MM-DD text, as the c engine reads
+    them. Other columns are returned unchanged.
+    """
+    if values.dtype != object or pd.api.types.infer_dtype(values) != "date":
+        return values
+    return pd.to_datetime(values).dt.strftime("%Y-%m-%d")
+
+
+def read_matching_columns(
+    csv_path, columns, numeric_columns, date_columns, cache_path=None, schema=None
+):
+    """
+    Reads only the given columns (where they exist) and patient_id from a csv,
+    with numeric columns read directly as float64, date columns as text, and
+    the others as their type in the schema if one is given.
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns
+    usecols = ["patient_id"] + [column for column in columns if column in header]
+    dtype = {}
+    if schema is not None:
+        dtype = get_schema_dtypes(schema, usecols)
+    for column in date_columns:
+        if column in header:
+            dtype.setdefault(column, "object")
+    dtype.update({column: "float64" for column in numeric_columns if column in header})
+    df = read_csv_cached(
+        csv_path,
+        cache_path,
+        usecols=usecols,
         index_col="patient_id",
+        dtype=dtype,
+        engine=get_csv_engine(),
     )
+    ## The pyarrow engine parses YYYY-MM-DD columns into dates whatever their
+    ## dtype
+    for column in date_columns:
+        if column in df.columns:
+            df[column] = get_date_text(df[column])
+    if schema is not None:
+        df = set_schema_types(df, schema)
+    return df
+
 
-    ## Set data types for matching variables
-    month_only = []
+def set_variable_types(
+    df,
+    match_variables,
+    date_exclusion_variables,
+    index_date_variable,
+    parse_index_date=True,
+    date_format=None,
+):
+    """
+    Sets the correct data types for the matching variables of an imported
+    table, and adds a {var}_m column holding the month of each month_only
+    variable.
+    """
     for var, match_type in match_variables.items():
         if match_type == "category":
-            cases[var] = cases[var].astype("category")
-            matches[var] = matches[var].astype("category")
+            df[var] = df[var].astype("category")
         ## Extract month from month_only variables
         elif match_type == "month_only":
-            month_only.append(var)
-            cases[f"{var}_m"] = cases[var].str.slice(start=5, stop=7).astype("category")
-            matches[f"{var}_m"] = (
-                matches[var].str.slice(start=5, stop=7).astype("category")
-            )
-    for var in month_only:
-        del match_variables[var]
-        match_variables[f"{var}_m"] = "category"
+            if isinstance(df[var].dtype, pd.CategoricalDtype):
+                df[f"{var}_m"] = get_month_categories(df[var])
+            elif pd.api.types.is_datetime64_dtype(df[var]):
+                df[f"{var}_m"] = df[var].dt.strftime("%m").astype("category")
+            else:
+                df[f"{var}_m"] = df[var].str.slice(start=5, stop=7).astype("category")
 
     ## Format exclusion variables as dates
     if date_exclusion_variables is not None:
         for var in date_exclusion_variables:
-            cases[var] = pd.to_datetime(cases[var])
-            matches[var] = pd.to_datetime(matches[var])
+            df[var] = pd.to_datetime(df[var], format=date_format)
     ## Format index date as date
-    cases[index_date_variable] = pd.to_datetime(cases[index_date_variable])
-    if replace_match_index_date_with_case is None:
-        matches[index_date_variable] = pd.to_datetime(matches[index_date_variable])
+    if parse_index_date:
+        df[index_date_variable] = pd.to_datetime(
+            df[index_date_variable], format=date_format
+        )
+    return df
+
+
+def expand_month_only(match_variables):
+    """
+    Replaces each month_only variable in match_variables with its {var}_m
+    column from set_variable_types, which is matched as a category.
+    """
+    month_only = [
+        var for var, match_type in match_variables.items() if match_type == "month_only"
+    ]
+    for var in month_only:
+        del match_variables[var]
+        match_variables[f"{var}_m"] = "category"
+
+
+def import_csv(
+    csv_path,
+    match_variables,
+    date_exclusion_variables,
+    index_date_variable,
+    parse_index_date=True,
+    closest_match_variables=None,
+    import_columns="all",
+    date_format=None,
+    cache_path=None,
+    schema=None,
+):
+    """
+    Imports one of the csvs for import_csvs, and sets its data types.
+    """
+    if import_columns == "all":
+        if schema is None:
+            df = read_csv_cached(csv_path, cache_path, index_col="patient_id")
+        else:
+            header = pd.read_csv(csv_path, nrows=0).columns
+            df = read_csv_cached(
+                csv_path,
+                cache_path,
+                index_col="patient_id",
+                dtype=get_schema_dtypes(schema, header),
+            )
+            df = set_schema_types(df, schema)
+    elif import_columns == "matching":
+        columns, numeric_columns, date_columns = get_matching_columns(
+            match_variables,
+            date_exclusion_variables,
+            index_date_variable,
+            closest_match_variables,
+        )
+        df = read_matching_columns(
+            csv_path, columns, numeric_columns, date_columns, cache_path, schema
+        )
+    else:
+        raise Exception(f"Import columns '{import_columns}' not implemented")
+    return set_variable_types(
+        df,
+        match_variables,
+        date_exclusion_variables,
+        index_date_variable,
+        parse_index_date,
+        date_format,
+    )
+
 
+def import_csvs(
+    case_csv,
+    match_csv,
+    match_variables,
+    date_exclusion_variables,
+    index_date_variable,
+    output_path,
+    replace_match_index_date_with_case=None,
+    closest_match_variables=None,
+    import_columns="all",
+    date_format=None,
+    cache_path=None,
+    schema=None,
+):
+    """
+    Imports the two csvs specified under case_csv and match_csv.
+    Also sets the correct data types for the matching variables.
+    import_columns="matching" only imports the columns needed to do the matching,
+    see read_matching_columns. The rest can be added back for the matched
+    patients with pull_back_columns. date_format is passed to pd.to_datetime.
+    If cache_path is given, imported columns are cached there in binary form and
+    reused while the csv is unchanged, see read_csv_cached.
+    If a schema (see study_schema.extract_schema) is given, the columns in it
+    are read as their type rather than as pandas infers them.
+    """
+    cases = import_csv(
+        os.path.join(output_path, f"{case_csv}.csv"),
+        match_variables,
+        date_exclusion_variables,
+        index_date_variable,
+        True,
+        closest_match_variables,
+        import_columns,
+        date_format,
+        cache_path,
+        schema,
+    )
+    matches = import_csv(
+        os.path.join(output_path, f"{match_csv}.csv"),
+        match_variables,
+        date_exclusion_variables,
+        index_date_variable,
+        replace_match_index_date_with_case is None,
+        closest_match_variables,
+        import_columns,
+        date_format,
+        cache_path,
+        schema,
+    )
+    expand_month_only(match_variables)
     return cases, matches
 
 
-def add_variables(cases, matches, indicator_variable_name="case"):
+def unify_dtypes(dtypes):
+    """
+    Returns the dtype that a column would have been given had it been read all
+    at once, from the dtypes it was given in each chunk.
+    """
+    dtypes = set(dtypes)
+    if len(dtypes) == 1:
+        return dtypes.pop()
+    if all(dtype.kind in "iuf" for dtype in dtypes):
+        return np.result_type(*dtypes)
+    return np.dtype(object)
+
+
+def is_nullable_integer(dtype):
+    """
+    Returns whether dtype is a pandas nullable integer dtype, such as Int32.
+    """
+    return pd.api.types.is_extension_array_dtype(
+        dtype
+    ) and pd.api.types.is_integer_dtype(dtype)
+
+
+def read_rows_by_id(csv_path, patient_ids, chunksize=None, dtype=None):
+    """
+    Reads every column of a csv, but only keeps the rows for the given
+    patient_ids, in that order. The csv is read in chunks so that it is never
+    all in memory, by default of READ_BACK_CELLS values, so that the memory
+    used does not grow with the number of columns. Columns in dtype are read
+    as the given dtype, except that nullable integers are made plain numpy
+    integers, or float64 if any of the csv's values are missing, as
+    study_schema.set_schema_types does for a whole column.
+    """
+    patient_ids = pd.Index(patient_ids)
+    if chunksize is None:
+        num_columns = len(pd.read_csv(csv_path, nrows=0).columns)
+        chunksize = max(1, READ_BACK_CELLS // max(num_columns, 1))
+    rows = []
+    chunk_dtypes = {}
+    missing = set()
+    dtype = dtype or {}
+    for chunk in pd.read_csv(
+        csv_path, index_col="patient_id", chunksize=chunksize, dtype=dtype or None
+    ):
+        for column, chunk_dtype in chunk.dtypes.items():
+            chunk_dtypes.setdefault(column, []).append(chunk_dtype)
+            if is_nullable_integer(chunk_dtype) and chunk[column].hasnans:
+                missing.add(column)
+        rows.append(chunk.loc[chunk.index.isin(patient_ids)])
+    rows = pd.concat(rows)
+    for column, dtypes in chunk_dtypes.items():
+        ## Categories differ between chunks, so are only set once they are joined
+        column_dtype = pd.api.types.pandas_dtype(
+            dtype.get(column, unify_dtypes(dtypes))
+        )
+        ## Whether the kept rows have missing values does not decide the type
+        if is_nullable_integer(column_dtype):
+            column_dtype = "float64" if column in missing else column_dtype.numpy_dtype
+        rows[column] = rows[column].astype(column_dtype)
+    return rows.reindex(patient_ids)
+
+
+def pull_back_columns(
+    narrow,
+    csv_path,
+    date_variables,
+    replaced_variables=(),
+    date_format=None,
+    schema=None,
+):
+    """
+    Adds back the columns that were not imported with import_columns="matching"
+    for the patients in narrow, by reading them again from csv_path. Dates are
+    formatted as by import_csvs. Columns that were added during matching, and
+    replaced_variables (whose values were changed during matching), are taken
+    from narrow. Returns a table laid out as if all columns had been imported.
+    """
+    if schema is None:
+        full = read_rows_by_id(csv_path, narrow.index)
+    else:
+        header = pd.read_csv(csv_path, nrows=0).columns
+        full = read_rows_by_id(
+            csv_path, narrow.index, dtype=get_schema_dtypes(schema, header)
+        )
+        full = set_schema_types(full, schema)
+    for var in date_variables:
+        full[var] = pd.to_datetime(full[var], format=date_format)
+    for column in narrow.columns:
+        if column not in full.columns or column in replaced_variables:
+            full[column] = narrow[column]
+    return full
+
+
+def add_variables(cases, matches, indicator_variable_name="case", random_seed=None):
     """
     Adds the following variables to the case and match tables:
     set_id - in the final table, this will be identify groups of matched cases
@@ -71,18 +405,59 @@ def add_variables(cases, matches, indicator_variable_name="case"):
     ...and these variables to the match table:
     randomise - this is used to randomly sort when selecting which matches to use.
                 A random seed is set so that the same matches are picked between
-                runs on the same input CSVs.
+                runs on the same input CSVs. With a random_seed, it is instead
+                derived from the patient ID, see get_randomise.
     """
     cases["set_id"] = cases.index
     matches["set_id"] = NOT_PREVIOUSLY_MATCHED
-    matches["randomise"] = 1
-    random.seed(999)
-    matches["randomise"] = matches["randomise"].apply(lambda x: x * random.random())
+    matches["randomise"] = get_randomise(matches.index, random_seed)
     cases[indicator_variable_name] = 1
     matches[indicator_variable_name] = 0
     return cases, matches
 
 
+def get_randomise(patient_ids, random_seed=None):
+    """
+    Returns the randomise variable for a match table with the given
+    patient_ids. By default these are the values of random.random() after
+    random.seed(999), one per row in row order, drawn at once by NumPy from
+    the same Mersenne Twister state. With a random_seed, each patient's value
+    is instead a hash of the seed and their patient_id, see hash_to_unit, so
+    it does not change when the rows are reordered or split up.
+    """
+    if random_seed is not None:
+        return hash_to_unit(patient_ids, random_seed)
+    state = random.Random(LEGACY_RANDOM_SEED).getstate()[1]
+    generator = np.random.RandomState()
+    generator.set_state(("MT19937", np.array(state[:-1], dtype=np.uint32), state[-1]))
+    return generator.random_sample(len(patient_ids))
+
+
+def mix64(values):
+    """
+    The SplitMix64 finaliser, which maps each uint64 to a well spread uint64.
+    """
+    with np.errstate(over="ignore"):
+        values = values + np.uint64(0x9E3779B97F4A7C15)
+        values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def hash_to_unit(keys, random_seed):
+    """
+    Returns a number in [0, 1) for each of keys (integer, or otherwise hashed
+    with pandas), which depends only on the key and random_seed.
+    """
+    keys = pd.Index(keys)
+    if pd.api.types.is_integer_dtype(keys.dtype):
+        keys = keys.to_numpy().astype(np.uint64)
+    else:
+        keys = pd.util.hash_array(keys.to_numpy(dtype=object))
+    seed = mix64(np.array([random_seed], dtype=np.uint64))
+    return (mix64(keys ^ seed) >> np.uint64(11)) * 2.0**-53
+
+
 def get_bool_index(match_type, value, match_var, matches):
     """
     Compares the value in the given case variable to the variable in
@@ -101,7 +476,8 @@ def get_bool_index(match_type, value, match_var, matches):
 def pre_calculate_indices(cases, matches, match_variables):
     """
     Loops over each of the values in the case table for each of the match
-    variables and generates a boolean Series against the match table. These are
+    variables and generates a boolean index against the match table. These are
+    stored as compressed Bitmaps, so that one per practice is affordable, and
     returned in a dict.
     """
     indices_dict = {}
@@ -112,187 +488,1921 @@ def pre_calculate_indices(cases, matches, match_variables):
         values = cases[match_var].unique()
         for value in values:
             index = get_bool_index(match_type, value, match_var, matches)
-            indices_dict[match_var][value] = index
+            indices_dict[match_var][value] = Bitmap.from_bool(index)
     return indices_dict
 
 
-def get_eligible_matches(case_row, matches, match_variables, indices):
+def to_days(dates):
     """
-    Loops over the match_variables and combines the boolean Series
-    from pre_calculate_indices into a single bool Series. Also removes previously
-    matched patients.
+    Converts a datetime Series to an int32 array of days since 1970-01-01,
+    with MISSING_DATE in place of missing dates.
     """
-    eligible_matches = pd.Series(data=True, index=matches.index)
-    for match_var in match_variables:
-        variable_bool = indices[match_var][case_row[match_var]]
-        eligible_matches = eligible_matches & variable_bool
+    days = dates.to_numpy(dtype="datetime64[ns]").astype("datetime64[D]")
+    days = days.astype(np.int64)
+    days[dates.isna().to_numpy()] = MISSING_DATE
+    return days.astype(np.int32)
 
-    not_previously_matched = matches["set_id"] == NOT_PREVIOUSLY_MATCHED
-    eligible_matches = eligible_matches & not_previously_matched
-    return eligible_matches
 
-
-def date_exclusions(df1, date_exclusion_variables, index_date):
+def collapse_date_exclusions(matches, date_exclusion_variables):
     """
-    Loops over the exclusion variables and creates a boolean Series corresponding
-    to where there are exclusion variables that occur before the index date.
-    index_date can be either a single value, or a pandas Series whose index
-    matches df1.
+    Collapses the date exclusion variables of the match table into the
+    earliest "before" date and the latest "after" date of each match, as int32
+    days. A match is excluded exactly when its earliest "before" date is on or
+    before the index date, or its latest "after" date is after it. Matches with
+    no "before" date get NO_BEFORE_DATE, and with no "after" date MISSING_DATE,
+    so that they are never excluded by them.
     """
-    exclusions = pd.Series(data=False, index=df1.index)
+    earliest_before = np.full(len(matches), NO_BEFORE_DATE, dtype=np.int32)
+    latest_after = np.full(len(matches), MISSING_DATE, dtype=np.int32)
     for exclusion_var, before_after in date_exclusion_variables.items():
+        dates = to_days(matches[exclusion_var])
         if before_after == "before":
-            variable_bool = df1[exclusion_var] <= index_date
+            dates[dates == MISSING_DATE] = NO_BEFORE_DATE
+            np.minimum(earliest_before, dates, out=earliest_before)
         elif before_after == "after":
-            variable_bool = df1[exclusion_var] > index_date
+            np.maximum(latest_after, dates, out=latest_after)
         else:
             raise Exception(f"Date exclusion type '{exclusion_var}' invalid")
-        exclusions = exclusions | variable_bool
-    return exclusions
+    return earliest_before, latest_after
 
 
-def greedily_pick_matches(
-    matches_per_case,
-    matched_rows,
-    case_row,
+def to_compact_numeric(values):
+    """
+    Converts a numeric Series to an int32 array where it only holds integers
+    that fit, otherwise to a float64 array (eg where values are missing).
+    """
+    values = pd.to_numeric(values)
+    if pd.api.types.is_integer_dtype(values.dtype):
+        info = np.iinfo(np.int32)
+        if len(values) == 0 or (values.min() >= info.min and values.max() <= info.max):
+            return values.to_numpy(dtype=np.int32)
+    return values.to_numpy(dtype=np.float64)
+
+
+def encode_matches(
+    matches,
+    match_variables,
+    index_date_variable,
     closest_match_variables=None,
+    date_exclusion_variables=None,
+    replace_match_index_date_with_case=None,
 ):
     """
-    Cuts the eligible_matches list to the number of matches specified. This is a
-    greedy matching method, so if closest_match_variables are specified, it sorts
-    on those variables to get the closest available matches for that case. It
-    always also sorts on random variable.
+    Builds the compact representation of the match table that the partitioned
+    engine works on: a dict of NumPy arrays, in the same row order as the table:
+    partition - one int64 code per combination of the exact ("category") match
+                variables. -1 where a value is missing.
+    match variables with an integer tolerance, and closest_match_variables -
+                int32 where possible, otherwise float64
+    earliest_before_date, latest_after_date - the date exclusion variables
+                collapsed by collapse_date_exclusions, int32 days since
+                1970-01-01
+    index_date_variable - int32 days, where matches keep their own index date
+    randomise - as in add_variables
+    Whether a match has been used is tracked separately while matching, so
+    set_id is not included. Also returns the categories of each exact match
+    variable, for encode_cases.
     """
-    sort_columns = []
+    match_pool = {}
+    categories = {}
+    match_keys = np.zeros(len(matches), dtype=np.int64)
+    match_missing = np.zeros(len(matches), dtype=bool)
+    numeric_variables = []
+    for match_var, match_type in match_variables.items():
+        if match_type == "category":
+            match_values = matches[match_var].astype("category")
+            categories[match_var] = match_values.cat.categories
+            match_codes = match_values.cat.codes.to_numpy()
+            match_keys = match_keys * len(categories[match_var]) + match_codes
+            match_missing |= match_codes == -1
+        else:
+            numeric_variables.append(match_var)
+    match_keys[match_missing] = -1
+    match_pool["partition"] = match_keys
+
     if closest_match_variables is not None:
-        for var in closest_match_variables:
-            matched_rows[f"{var}_delta"] = abs(matched_rows[var] - case_row[var])
-            sort_columns.append(f"{var}_delta")
+        numeric_variables.extend(closest_match_variables)
+    for var in numeric_variables:
+        match_pool[var] = to_compact_numeric(matches[var])
 
-    sort_columns.append("randomise")
-    matched_rows = matched_rows.sort_values(sort_columns)
-    matched_rows = matched_rows.head(matches_per_case)
-    return matched_rows.index
+    if date_exclusion_variables is not None:
+        (
+            match_pool["earliest_before_date"],
+            match_pool["latest_after_date"],
+        ) = collapse_date_exclusions(matches, date_exclusion_variables)
 
+    if replace_match_index_date_with_case is None:
+        match_pool[index_date_variable] = to_days(matches[index_date_variable])
 
-def get_date_offset(offset_str):
-    """
-    Parses the string given by replace_match_index_date_with_case
-    to determine the unit and length of offset.
-    Returns a pr.DateOffset of the appropriate length.
-    """
-    if offset_str == "no_offset":
-        offset = None
-    else:
-        length = int(offset_str.split("_")[0])
-        unit = offset_str.split("_")[1]
-        if unit in ("year", "years"):
-            offset = pd.DateOffset(years=length)
-        elif unit in ("month", "months"):
-            offset = pd.DateOffset(months=length)
-        elif unit in ("day", "days"):
-            offset = pd.DateOffset(days=length)
-        else:
-            raise Exception(f"Date offset '{unit}' not implemented")
-    return offset
+    match_pool["randomise"] = matches["randomise"].to_numpy(dtype=np.float64)
+    return match_pool, categories
 
 
-def match(
-    case_csv,
-    match_csv,
-    matches_per_case,
+def encode_cases(
+    cases,
+    categories,
     match_variables,
     index_date_variable,
     closest_match_variables=None,
-    date_exclusion_variables=None,
-    min_matches_per_case=0,
     replace_match_index_date_with_case=None,
-    indicator_variable_name="case",
-    output_suffix="",
-    output_path="output",
 ):
     """
-    Wrapper function that calls functions to:
-    - import data
-    - find eligible matches
-    - pick the correct number of randomly allocated matches
-    - make exclusions that are based on index date
-      - (this is not currently possible in a study definition, and will only ever be possible
-        during matching for studies where the match index date comes from the case)
-    - set the set_id as that of the case_id (this excludes them from being matched later)
-    - set the index date of the match as that of the case (where desired)
-    - save the results as a csv
+    Builds the compact representation of the case table, matching that of
+    encode_matches. The partition code is -1 where a value is missing or does
+    not occur in the matches. The index date is that which will be given to the
+    case's matches.
     """
-    assert (
-        min_matches_per_case <= matches_per_case
-    ), "min_matches_per_case cannot be greater than matches_per_case"
-
-    report_path = os.path.join(
-        output_path,
-        f"matching_report{output_suffix}.txt",
-    )
+    case_pool = {}
+    case_keys = np.zeros(len(cases), dtype=np.int64)
+    case_missing = np.zeros(len(cases), dtype=bool)
+    numeric_variables = []
+    for match_var, match_type in match_variables.items():
+        if match_type == "category":
+            case_codes = pd.Categorical(
+                cases[match_var], categories=categories[match_var]
+            ).codes
+            case_keys = case_keys * len(categories[match_var]) + case_codes
+            case_missing |= case_codes == -1
+        else:
+            numeric_variables.append(match_var)
+    case_keys[case_missing] = -1
+    case_pool["partition"] = case_keys
 
-    def matching_report(text_to_write, erase=False):
-        if erase and os.path.isfile(report_path):
-            os.remove(report_path)
-        with open(report_path, "a") as txt:
-            for line in text_to_write:
-                txt.writelines(f"{line}\n")
-                print(line)
-            txt.writelines("\n")
-            print("\n")
+    if closest_match_variables is not None:
+        numeric_variables.extend(closest_match_variables)
+    for var in numeric_variables:
+        case_pool[var] = to_compact_numeric(cases[var])
 
-    matching_report(
-        [f"Matching started at: {datetime.now()}"],
-        erase=True,
-    )
+    if replace_match_index_date_with_case is not None:
+        case_pool[index_date_variable] = to_days(
+            get_match_index_date(
+                cases[index_date_variable], replace_match_index_date_with_case
+            )
+        )
+    return case_pool
 
-    ## Deep copy match_variables
-    match_variables = copy.deepcopy(match_variables)
 
-    ## Import_data
-    cases, matches = import_csvs(
-        case_csv,
-        match_csv,
+def encode_match_pool(
+    cases,
+    matches,
+    match_variables,
+    index_date_variable,
+    closest_match_variables=None,
+    date_exclusion_variables=None,
+    replace_match_index_date_with_case=None,
+):
+    """
+    Builds the compact representations of the case and match tables with
+    encode_cases and encode_matches.
+    """
+    match_pool, categories = encode_matches(
+        matches,
         match_variables,
+        index_date_variable,
+        closest_match_variables,
         date_exclusion_variables,
+        replace_match_index_date_with_case,
+    )
+    case_pool = encode_cases(
+        cases,
+        categories,
+        match_variables,
         index_date_variable,
-        output_path,
+        closest_match_variables,
         replace_match_index_date_with_case,
     )
+    return case_pool, match_pool
 
-    matching_report(
-        [
-            "CSV import:",
-            f"Completed {datetime.now()}",
-            f"Cases    {len(cases)}",
-            f"Matches  {len(matches)}",
-        ],
-    )
 
-    ## Drop cases from match population
-    ## WARNING - this will cause issues in dummy data where population
-    ## sizes are the same, as the indices will be identical.
-    matches = matches.drop(cases.index, errors="ignore")
+def get_range_variable(match_variables, closest_match_variables=None):
+    """
+    Picks the match variable with an integer tolerance that the partitions are
+    sorted on, so that its tolerance window can be found by binary search.
+    Prefers the first of the closest_match_variables, so that the same order
+    can be used to pick the closest matches. Returns None if there is no match
+    variable with an integer tolerance.
+    """
+    tolerance_variables = [
+        match_var
+        for match_var, match_type in match_variables.items()
+        if isinstance(match_type, int)
+    ]
+    if len(tolerance_variables) == 0:
+        return None
+    if (
+        closest_match_variables is not None
+        and closest_match_variables[0] in tolerance_variables
+    ):
+        return closest_match_variables[0]
+    return tolerance_variables[0]
 
-    matching_report(
-        [
-            "Dropping cases from matches:",
-            f"Completed {datetime.now()}",
-            f"Cases    {len(cases)}",
-            f"Matches  {len(matches)}",
-        ]
-    )
 
-    ## Add set_id and randomise variables
-    cases, matches = add_variables(cases, matches, indicator_variable_name)
+def sort_match_pool(match_pool, range_variable=None):
+    """
+    Sorts the match pool by its partition code, ie by the variables that are
+    matched exactly, leaving out matches with a missing exact match variable as
+    they can never be matched. Within a partition, positions are in ascending
+    order or, with a range_variable, sorted on it and then on randomise.
+    Returns the sorted positions, the partition codes, and the bounds of each
+    partition in the sorted positions (one more than the number of partitions).
+    """
+    keys = match_pool["partition"]
+    if range_variable is None:
+        order = np.argsort(keys, kind="stable")
+    else:
+        order = np.lexsort((match_pool["randomise"], match_pool[range_variable], keys))
+    order = order[keys[order] != -1]
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.diff(sorted_keys, prepend=-2) != 0)
+    bounds = np.append(starts, len(order))
+    return order, sorted_keys[starts], bounds
 
-    indices = pre_calculate_indices(cases, matches, match_variables)
-    matching_report([f"Completed pre-calculating indices at {datetime.now()}"])
 
-    if replace_match_index_date_with_case is not None:
-        offset_str = replace_match_index_date_with_case
-        date_offset = get_date_offset(replace_match_index_date_with_case)
+def split_partitions(order, partition_keys, bounds, sorted_values=None):
+    """
+    Splits the output of sort_match_pool into a dict mapping each partition
+    code to the positions of the matches in it, and (if sorted_values, the
+    range variable's values in the same order, are given) a dict mapping each
+    partition code to those values. Both hold views, not copies.
+    """
+    partitions = {}
+    range_values = {}
+    for number, key in enumerate(partition_keys):
+        start, end = bounds[number], bounds[number + 1]
+        partitions[key] = order[start:end]
+        if sorted_values is not None:
+            range_values[key] = sorted_values[start:end]
+    return partitions, range_values
+
+
+def partition_matches(match_pool, range_variable=None):
+    """
+    Groups the match pool once by its partition code, ie by the variables that
+    are matched exactly. Returns a dict mapping each partition code to the
+    positions of the matches in it, and a dict mapping each partition code to
+    the values of range_variable for those positions.
+    Without a range_variable the positions are in ascending order. With one,
+    they are sorted on range_variable, then on randomise, and the dict of
+    values can be binary searched. Matches with a missing exact match variable
+    are left out, as they can never be matched.
+    """
+    order, partition_keys, bounds = sort_match_pool(match_pool, range_variable)
+    sorted_values = None
+    if range_variable is not None:
+        sorted_values = match_pool[range_variable][order]
+    return split_partitions(order, partition_keys, bounds, sorted_values)
+
+
+def get_range_window(values, value, tolerance):
+    """
+    Binary searches the sorted values of a partition for those within
+    tolerance of value, ie whose absolute difference from it is at most
+    tolerance, as get_bool_index compares them. Returns the start and end of
+    the window.
+    """
+    if value != value:
+        return 0, 0
+    start = np.searchsorted(values, value - tolerance, side="left")
+    end = np.searchsorted(values, value + tolerance, side="right")
+    ## value - tolerance and value + tolerance can round differently from the
+    ## differences, so the ends are moved to agree with them
+    while start > 0 and abs(values[start - 1] - value) <= tolerance:
+        start = np.searchsorted(values, values[start - 1], side="left")
+    while start < end and abs(values[start] - value) > tolerance:
+        start = np.searchsorted(values, values[start], side="right")
+    while end < len(values) and abs(values[end] - value) <= tolerance:
+        end = np.searchsorted(values, values[end], side="right")
+    while end > start and abs(values[end - 1] - value) > tolerance:
+        end = np.searchsorted(values, values[end - 1], side="left")
+    return start, max(start, end)
+
+
+def get_range_windows(values, case_values, tolerance):
+    """
+    Equivalent of get_range_window for an array of case_values at once.
+    Returns arrays of the starts and ends of the windows.
+    """
+    starts = np.searchsorted(values, case_values - tolerance, side="left")
+    ends = np.searchsorted(values, case_values + tolerance, side="right")
+    last = len(values) - 1
+
+    def within(positions):
+        return np.abs(values[np.clip(positions, 0, last)] - case_values) <= tolerance
+
+    ## As in get_range_window, the ends are moved to agree with the differences
+    while True:
+        move = (starts > 0) & within(starts - 1)
+        if not move.any():
+            break
+        starts[move] = np.searchsorted(values, values[starts[move] - 1], side="left")
+    while True:
+        move = (starts < ends) & ~within(starts)
+        if not move.any():
+            break
+        starts[move] = np.searchsorted(values, values[starts[move]], side="right")
+    while True:
+        move = (ends <= last) & within(ends)
+        if not move.any():
+            break
+        ends[move] = np.searchsorted(values, values[ends[move]], side="right")
+    while True:
+        move = (ends > starts) & ~within(ends - 1)
+        if not move.any():
+            break
+        ends[move] = np.searchsorted(values, values[ends[move] - 1], side="left")
+    return starts, np.maximum(starts, ends)
+
+
+def get_partition_matches(
+    case_position,
+    case_pool,
+    match_pool,
+    match_variables,
+    positions,
+    taken,
+    range_variable=None,
+):
+    """
+    Equivalent of get_eligible_matches for the partitioned engine. Only the
+    matches in the case's partition are compared, so the exact match variables
+    are already satisfied. The range_variable is also skipped, as positions are
+    expected to be from its window already. Only the remaining match variables
+    and previous matching, given by the taken Bitmap, need to be checked.
+    Returns the positions of the eligible matches.
+    """
+    eligible_matches = ~taken.contains(positions)
+    for match_var, match_type in match_variables.items():
+        if match_type == "category" or match_var == range_variable:
+            continue
+        elif isinstance(match_type, int):
+            value = case_pool[match_var][case_position]
+            variable_bool = (
+                np.abs(match_pool[match_var][positions] - value) <= match_type
+            )
+        else:
+            raise Exception(f"Matching type '{match_type}' not yet implemented")
+        eligible_matches &= variable_bool
+    return positions[eligible_matches]
+
+
+def pool_date_exclusions(match_pool, positions, index_date):
+    """
+    Equivalent of date_exclusions for the partitioned engine, comparing the
+    collapsed exclusion dates (see collapse_date_exclusions) of the matches at
+    the given positions to index_date, which is either a single value or an
+    array aligned with positions. All dates are in days, so missing dates never
+    cause an exclusion.
+    """
+    exclusions = match_pool["earliest_before_date"][positions] <= index_date
+    exclusions |= match_pool["latest_after_date"][positions] > index_date
+    return exclusions & (index_date != MISSING_DATE)
+
+
+def pool_pick_matches(
+    matches_per_case,
+    positions,
+    case_position,
+    case_pool,
+    match_pool,
+    closest_match_variables=None,
+):
+    """
+    Equivalent of greedily_pick_matches for the partitioned engine. Sorts the
+    positions of the eligible matches on the distance from the case for each of
+    the closest_match_variables and then on the random variable, and returns
+    the first matches_per_case of them.
+    """
+    sort_keys = []
+    if closest_match_variables is not None:
+        for var in closest_match_variables:
+            value = case_pool[var][case_position]
+            sort_keys.append(np.abs(match_pool[var][positions] - value))
+    sort_keys.append(match_pool["randomise"][positions])
+    return positions[top_k_order(matches_per_case, sort_keys)]
+
+
+def pick_matches_outward(
+    matches_per_case, positions, values, value, randomise, get_eligible
+):
+    """
+    Equivalent of pool_pick_matches when the only closest match variable is
+    the range variable. positions are sorted on that variable (values), then
+    on randomise, so the closest matches are found by reading outward from
+    value, one block of equally distant values at a time, until there are
+    enough. get_eligible filters a block down to its eligible positions.
+    """
+    picked = []
+    num_picked = 0
+    right = np.searchsorted(values, value, side="left")
+    left = right
+    while num_picked < matches_per_case and (left > 0 or right < len(values)):
+        left_delta = value - values[left - 1] if left > 0 else np.inf
+        right_delta = values[right] - value if right < len(values) else np.inf
+        delta = min(left_delta, right_delta)
+        blocks = []
+        if left_delta == delta:
+            start = np.searchsorted(values[:left], values[left - 1], side="left")
+            blocks.append(positions[start:left])
+            left = start
+        if right_delta == delta:
+            end = right + np.searchsorted(values[right:], values[right], side="right")
+            blocks.append(positions[right:end])
+            right = end
+        if len(blocks) == 1:
+            block = get_eligible(blocks[0])
+        else:
+            ## Equally distant values either side, so merge them on randomise
+            block = get_eligible(np.concatenate(blocks))
+            block = block[np.argsort(randomise[block], kind="stable")]
+        block = block[: matches_per_case - num_picked]
+        picked.append(block)
+        num_picked += len(block)
+    if len(picked) == 0:
+        return positions[:0]
+    return np.concatenate(picked)
+
+
+def get_eligible_matches(case_row, matches, match_variables, indices, matched):
+    """
+    Loops over the match_variables and combines the Bitmaps from
+    pre_calculate_indices into a single boolean array, starting from the
+    smallest. Also removes previously matched patients, given by the matched
+    Bitmap.
+    """
+    bitmaps = sorted(
+        (indices[match_var][case_row[match_var]] for match_var in match_variables),
+        key=Bitmap.cardinality,
+    )
+    if len(bitmaps) == 0:
+        bitmaps = [Bitmap.full(len(matches))]
+    eligible_matches = bitmaps[0]
+    for variable_bitmap in bitmaps[1:]:
+        eligible_matches = eligible_matches.intersect(variable_bitmap)
+
+    eligible_matches = eligible_matches.difference(matched)
+    return eligible_matches.to_bool()
+
+
+def date_exclusions(df1, date_exclusion_variables, index_date):
+    """
+    Loops over the exclusion variables and creates a boolean Series corresponding
+    to where there are exclusion variables that occur before the index date.
+    index_date can be either a single value, or a pandas Series whose index
+    matches df1.
+    """
+    exclusions = pd.Series(data=False, index=df1.index)
+    for exclusion_var, before_after in date_exclusion_variables.items():
+        if before_after == "before":
+            variable_bool = df1[exclusion_var] <= index_date
+        elif before_after == "after":
+            variable_bool = df1[exclusion_var] > index_date
+        else:
+            raise Exception(f"Date exclusion type '{exclusion_var}' invalid")
+        exclusions = exclusions | variable_bool
+    return exclusions
+
+
+def greedily_pick_matches(
+    matches_per_case,
+    matched_rows,
+    case_row,
+    closest_match_variables=None,
+):
+    """
+    Cuts the eligible_matches list to the number of matches specified. This is a
+    greedy matching method, so if closest_match_variables are specified, it sorts
+    on those variables to get the closest available matches for that case. It
+    always also sorts on random variable. Only the matches that could be in the
+    first matches_per_case are sorted, see top_k_order.
+    """
+    sort_keys = []
+    if closest_match_variables is not None:
+        for var in closest_match_variables:
+            values = matched_rows[var].to_numpy(dtype=np.float64)
+            sort_keys.append(np.abs(values - case_row[var]))
+
+    sort_keys.append(matched_rows["randomise"].to_numpy())
+    return matched_rows.index[top_k_order(matches_per_case, sort_keys)]
+
+
+def top_k_order(matches_per_case, sort_keys):
+    """
+    Returns the positions of the first matches_per_case rows when sorted on the
+    arrays in sort_keys, the first taking priority, without sorting every row.
+    The cut-off on the first key is found by partial selection, and only the
+    rows up to and including it are sorted, so that the order is the same as
+    sorting all of them. Missing values sort last.
+    """
+    candidates = np.arange(len(sort_keys[0]))
+    if len(candidates) > matches_per_case > 0:
+        first_key = sort_keys[0]
+        cut_off = np.partition(first_key, matches_per_case - 1)[matches_per_case - 1]
+        ## A missing cut-off means there are not enough non-missing values
+        if cut_off == cut_off:
+            candidates = np.flatnonzero(first_key <= cut_off)
+    order = np.lexsort([sort_key[candidates] for sort_key in reversed(sort_keys)])
+    return candidates[order[:matches_per_case]]
+
+
+def get_date_offset(offset_str):
+    """
+    Parses the string given by replace_match_index_date_with_case
+    to determine the unit and length of offset.
+    Returns a pr.DateOffset of the appropriate length.
+    """
+    if offset_str == "no_offset":
+        offset = None
+    else:
+        length = int(offset_str.split("_")[0])
+        unit = offset_str.split("_")[1]
+        if unit in ("year", "years"):
+            offset = pd.DateOffset(years=length)
+        elif unit in ("month", "months"):
+            offset = pd.DateOffset(months=length)
+        elif unit in ("day", "days"):
+            offset = pd.DateOffset(days=length)
+        else:
+            raise Exception(f"Date offset '{unit}' not implemented")
+    return offset
+
+
+def get_match_index_date(case_index_date, offset_str):
+    """
+    Applies the offset given by replace_match_index_date_with_case to the case
+    index date, which can be either a single value or a pandas Series, to give
+    the index date of its matches.
+    """
+    date_offset = get_date_offset(offset_str)
+    if offset_str == "no_offset":
+        index_date = case_index_date
+    elif offset_str.split("_")[2] == "earlier":
+        index_date = case_index_date - date_offset
+    elif offset_str.split("_")[2] == "later":
+        index_date = case_index_date + date_offset
+    else:
+        raise Exception(f"Date offset type '{offset_str}' not recognised")
+    return index_date
+
+
+def match_cases_reference(
+    cases,
+    matches,
+    matches_per_case,
+    match_variables,
+    indices,
+    index_date_variable,
+    closest_match_variables=None,
+    date_exclusion_variables=None,
+    min_matches_per_case=0,
+    replace_match_index_date_with_case=None,
+    progress=None,
+    profiler=None,
+):
+    """
+    Matching loop for engine="reference". Goes through the cases in order,
+    comparing each one against the whole match table. Records the number of
+    matches in cases["match_counts"] and labels the matches in place.
+    progress, if given, is called with the position of each case, and
+    profiler, if given, is a Profiler that times each step.
+    """
+    ## Patients that have already been matched, kept up to date in place
+    matched = Bitmap.empty(len(matches))
+
+    for case_position, (case_id, case_row) in enumerate(cases.iterrows()):
+        if progress is not None:
+            progress(case_position)
+        if profiler is not None:
+            case_started = time.perf_counter()
+
+        ## Get eligible matches
+        with profile_section(profiler, "get_eligible_matches"):
+            eligible_matches = get_eligible_matches(
+                case_row, matches, match_variables, indices, matched
+            )
+            matched_rows = matches.loc[eligible_matches]
+
+        ## Determine match index date
+        if replace_match_index_date_with_case is None:
+            index_date = matched_rows[index_date_variable]
+        else:
+            index_date = get_match_index_date(
+                case_row[index_date_variable], replace_match_index_date_with_case
+            )
+
+        ## Index date based match exclusions (faster to do this after get_eligible_matches)
+        if date_exclusion_variables is not None:
+            with profile_section(profiler, "date_exclusions"):
+                exclusions = date_exclusions(
+                    matched_rows, date_exclusion_variables, index_date
+                )
+                matched_rows = matched_rows.loc[~exclusions]
+        pool_size = len(matched_rows)
+
+        ## Pick random matches
+        with profile_section(profiler, "greedily_pick_matches"):
+            matched_rows = greedily_pick_matches(
+                matches_per_case,
+                matched_rows,
+                case_row,
+                closest_match_variables,
+            )
+
+        with profile_section(profiler, "loc_write_back"):
+            ## Report number of matches for each case
+            num_matches = len(matched_rows)
+            cases.loc[case_id, "match_counts"] = num_matches
+
+            ## Label matches with case ID if there are enough
+            if num_matches >= min_matches_per_case:
+                matches.loc[matched_rows, "set_id"] = case_id
+                matched.add(matches.index.get_indexer(matched_rows))
+
+            ## Set index_date of the match where needed
+            if replace_match_index_date_with_case is not None:
+                matches.loc[matched_rows, index_date_variable] = index_date
+
+        if profiler is not None:
+            profiler.record_case(
+                case_position, -1, pool_size, time.perf_counter() - case_started
+            )
+
+
+def get_case_window(
+    case_position, case_pool, partitions, range_values, range_variable, match_variables
+):
+    """
+    Returns the positions of the matches in a case's partition and, where
+    there is a range_variable, only those within its tolerance window, with
+    their values of the range_variable and the case's value.
+    """
+    positions = partitions[case_pool["partition"][case_position]]
+    values = value = None
+    if range_variable is not None:
+        values = range_values[case_pool["partition"][case_position]]
+        value = case_pool[range_variable][case_position]
+        start, end = get_range_window(values, value, match_variables[range_variable])
+        positions = positions[start:end]
+        values = values[start:end]
+    return positions, values, value
+
+
+def count_candidates(
+    case_pool, partitions, range_values, range_variable, match_variables
+):
+    """
+    Counts the matches in each case's partition and, where there is a
+    range_variable, within its tolerance window, ie the matches the case could
+    get before the other tolerances, the date exclusions and the matches taken
+    by other cases are applied. Cases are grouped by partition, and each
+    partition's windows are found in one binary search for all its cases.
+    """
+    keys = case_pool["partition"]
+    counts = np.zeros(len(keys), dtype=np.int64)
+    order = np.argsort(keys, kind="stable")
+    starts = np.flatnonzero(np.diff(keys[order], prepend=-2) != 0)
+    for case_positions in np.split(order, starts[1:]):
+        key = keys[case_positions[0]] if len(case_positions) > 0 else -1
+        if key not in partitions:
+            continue
+        if range_variable is None:
+            counts[case_positions] = len(partitions[key])
+            continue
+        starts, ends = get_range_windows(
+            range_values[key],
+            case_pool[range_variable][case_positions],
+            match_variables[range_variable],
+        )
+        counts[case_positions] = ends - starts
+    return counts
+
+
+def summarise_supply(candidate_counts, matches_per_case, min_matches_per_case=0):
+    """
+    Summarises the counts from count_candidates, for the report and metrics.
+    """
+    quantiles = [0, 0.1, 0.25, 0.5, 0.75, 0.9, 1]
+    return {
+        "cases_without_candidates": int((candidate_counts == 0).sum()),
+        "cases_below_matches_per_case": int(
+            (candidate_counts < matches_per_case).sum()
+        ),
+        "cases_below_min_matches_per_case": int(
+            (candidate_counts < min_matches_per_case).sum()
+        ),
+        "candidates_per_case_quantiles": {
+            str(quantile): float(value)
+            for quantile, value in zip(
+                quantiles,
+                (
+                    np.quantile(candidate_counts, quantiles)
+                    if len(candidate_counts) > 0
+                    else [np.nan] * len(quantiles)
+                ),
+            )
+        },
+    }
+
+
+def get_eligible_positions(
+    case_position,
+    positions,
+    case_pool,
+    match_pool,
+    match_variables,
+    taken,
+    range_variable,
+    index_date_variable,
+    date_exclusion_variables=None,
+    replace_match_index_date_with_case=None,
+    profiler=None,
+):
+    """
+    Filters the positions from a case's window down to the eligible matches,
+    with get_partition_matches and then pool_date_exclusions.
+    """
+    ## Get eligible matches
+    with profile_section(profiler, "get_partition_matches"):
+        positions = get_partition_matches(
+            case_position,
+            case_pool,
+            match_pool,
+            match_variables,
+            positions,
+            taken,
+            range_variable,
+        )
+
+    ## Index date based match exclusions
+    if date_exclusion_variables is not None:
+        with profile_section(profiler, "pool_date_exclusions"):
+            if replace_match_index_date_with_case is None:
+                match_index_date = match_pool[index_date_variable][positions]
+            else:
+                match_index_date = case_pool[index_date_variable][case_position]
+            exclusions = pool_date_exclusions(match_pool, positions, match_index_date)
+            positions = positions[~exclusions]
+    return positions
+
+
+def match_case_positions(
+    case_positions,
+    case_pool,
+    match_pool,
+    partitions,
+    range_values,
+    range_variable,
+    matches_per_case,
+    match_variables,
+    index_date_variable,
+    closest_match_variables=None,
+    date_exclusion_variables=None,
+    min_matches_per_case=0,
+    replace_match_index_date_with_case=None,
+    taken_positions=None,
+    progress=None,
+    profiler=None,
+    assignment="greedy",
+):
+    """
+    Matching loop for engine="partitioned". Goes through the given cases
+    (positions in case_pool) in order, only comparing each one against the
+    matches in its own partition, using the arrays from encode_match_pool and
+    the partitions from partition_matches. Where there is a range_variable, only
+    its tolerance window is compared and, if it is the only closest match
+    variable, matches are picked reading outward from the case's value.
+    taken_positions are the positions of matches already taken by earlier
+    cases, when continuing from a checkpoint. progress, if given, is called
+    with the position of each case, and profiler, if given, is a Profiler
+    that times each step. assignment="optimal" runs match_case_positions_optimal
+    instead.
+    Returns a list with the positions of the matches picked for each case.
+    """
+    if assignment == "optimal":
+        return match_case_positions_optimal(
+            case_positions,
+            case_pool,
+            match_pool,
+            partitions,
+            range_values,
+            range_variable,
+            matches_per_case,
+            match_variables,
+            index_date_variable,
+            closest_match_variables,
+            date_exclusion_variables,
+            min_matches_per_case,
+            replace_match_index_date_with_case,
+            taken_positions,
+            progress,
+            profiler,
+        )
+
+    ## Matches that have been used, and the number in each partition that
+    ## have not, are updated as matches are taken rather than recalculated
+    taken = Bitmap.empty(len(match_pool["randomise"]))
+    remaining = {key: len(positions) for key, positions in partitions.items()}
+    if taken_positions is not None and len(taken_positions) > 0:
+        taken.add(taken_positions)
+        keys, counts = np.unique(
+            match_pool["partition"][taken_positions], return_counts=True
+        )
+        for key, count in zip(keys, counts):
+            remaining[key] -= count
+    read_outward = range_variable is not None and closest_match_variables == [
+        range_variable
+    ]
+    picked = []
+
+    for case_position in case_positions:
+        if progress is not None:
+            progress(case_position)
+        if profiler is not None:
+            case_started = time.perf_counter()
+
+        key = case_pool["partition"][case_position]
+        ## Stop early if the case's partition is empty or used up
+        if remaining.get(key, 0) == 0:
+            picked.append(np.array([], dtype=np.int64))
+            if profiler is not None:
+                profiler.record_case(
+                    case_position, key, 0, time.perf_counter() - case_started
+                )
+            continue
+
+        positions, values, value = get_case_window(
+            case_position,
+            case_pool,
+            partitions,
+            range_values,
+            range_variable,
+            match_variables,
+        )
+
+        def get_eligible(positions, profiler=profiler):
+            return get_eligible_positions(
+                case_position,
+                positions,
+                case_pool,
+                match_pool,
+                match_variables,
+                taken,
+                range_variable,
+                index_date_variable,
+                date_exclusion_variables,
+                replace_match_index_date_with_case,
+                profiler,
+            )
+
+        ## Pick random matches
+        if read_outward:
+            if profiler is not None:
+                ## Reading outward only filters as much of the window as it
+                ## needs, so the eligible matches are counted separately, and
+                ## not timed
+                counting_started = time.perf_counter()
+                pool_size = len(get_eligible(positions, None))
+                case_started += time.perf_counter() - counting_started
+            with profile_section(profiler, "pick_matches_outward"):
+                positions = pick_matches_outward(
+                    matches_per_case,
+                    positions,
+                    values,
+                    value,
+                    match_pool["randomise"],
+                    get_eligible,
+                )
+        else:
+            eligible = get_eligible(positions)
+            pool_size = len(eligible)
+            with profile_section(profiler, "pool_pick_matches"):
+                positions = pool_pick_matches(
+                    matches_per_case,
+                    eligible,
+                    case_position,
+                    case_pool,
+                    match_pool,
+                    closest_match_variables,
+                )
+        picked.append(positions)
+
+        ## Take the matches if there are enough
+        if len(positions) >= min_matches_per_case:
+            taken.add(positions)
+            remaining[key] -= len(positions)
+
+        if profiler is not None:
+            profiler.record_case(
+                case_position, key, pool_size, time.perf_counter() - case_started
+            )
+
+    return picked
+
+
+def import_bipartite_matching():
+    """
+    Imports the sparse minimum cost bipartite matching from scipy, which is
+    only needed for assignment="optimal".
+    """
+    try:
+        from scipy.sparse import csr_matrix
+        from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+    except ImportError:
+        raise Exception("assignment='optimal' needs scipy to be installed")
+    return csr_matrix, min_weight_full_bipartite_matching
+
+
+def assign_optimally(candidates, costs, matches_per_case):
+    """
+    Solves the minimum cost assignment of matches to cases, where candidates
+    holds the positions of the eligible matches of each case and costs their
+    distances from it. Each case has matches_per_case slots, and each slot is
+    either given one match or left empty. Leaving a case's slot j (from 0)
+    empty costs (matches_per_case - j) * E, where E is more than any total
+    distance, so each match a case gets is worth E less than the one before:
+    its first is worth matches_per_case * E, its last E. As the worth of a
+    case's matches is concave in their number, the assignment spreads the
+    matches over as many cases as it can rather than filling some cases up,
+    though as a trade-off between cases rather than a strict order. It has
+    the smallest total cost of empty slots and, among the assignments that
+    do, the smallest total distance. Only the eligible pairs are in the
+    (sparse) cost matrix, with one extra column per slot for leaving it
+    empty, so a full assignment always exists.
+    Returns the positions assigned to each case.
+    """
+    csr_matrix, min_weight_full_bipartite_matching = import_bipartite_matching()
+    num_cases = len(candidates)
+    num_slots = num_cases * matches_per_case
+    candidate_counts = np.array([len(positions) for positions in candidates])
+    if candidate_counts.sum() == 0:
+        return [positions[:0] for positions in candidates]
+
+    columns, column_index = np.unique(np.concatenate(candidates), return_inverse=True)
+    ## Shifted by 1 so that no weight is zero, which would not be an edge
+    weights = np.concatenate(costs).astype(np.float64) + 1
+    known = ~np.isnan(weights)
+    weights[~known] = weights[known].max() + 1 if known.any() else 1
+    empty_slot_cost = num_slots * weights.max() + 1
+
+    ## Each case's candidates repeated for each of its slots
+    row_starts = np.repeat(
+        np.cumsum(candidate_counts) - candidate_counts, matches_per_case
+    )
+    row_lengths = np.repeat(candidate_counts, matches_per_case)
+    row_offsets = np.cumsum(row_lengths) - row_lengths
+    edge_index = np.arange(row_lengths.sum()) + np.repeat(
+        row_starts - row_offsets, row_lengths
+    )
+    slots = np.arange(num_slots)
+    rows = np.concatenate([np.repeat(slots, row_lengths), slots])
+    cols = np.concatenate([column_index[edge_index], len(columns) + slots])
+    data = np.concatenate(
+        [
+            weights[edge_index],
+            empty_slot_cost * (matches_per_case - slots % matches_per_case),
+        ]
+    )
+    biadjacency = csr_matrix(
+        (data, (rows, cols)), shape=(num_slots, len(columns) + num_slots)
+    )
+    slot_rows, slot_columns = min_weight_full_bipartite_matching(biadjacency)
+
+    assigned = [[] for _ in range(num_cases)]
+    for row, column in zip(slot_rows, slot_columns):
+        if column < len(columns):
+            assigned[row // matches_per_case].append(columns[column])
+    return [np.sort(np.array(positions, dtype=np.int64)) for positions in assigned]
+
+
+def match_case_positions_optimal(
+    case_positions,
+    case_pool,
+    match_pool,
+    partitions,
+    range_values,
+    range_variable,
+    matches_per_case,
+    match_variables,
+    index_date_variable,
+    closest_match_variables=None,
+    date_exclusion_variables=None,
+    min_matches_per_case=0,
+    replace_match_index_date_with_case=None,
+    taken_positions=None,
+    progress=None,
+    profiler=None,
+):
+    """
+    Alternative to match_case_positions for assignment="optimal". Rather than
+    picking the closest matches for one case at a time, in index date order,
+    it assigns the matches of each partition to all its cases at once with
+    assign_optimally, with the sum of the distances on the
+    closest_match_variables as the cost. As assign_optimally spreads the
+    matches over as many cases as it can, cases can get fewer than
+    min_matches_per_case matches. Those furthest short are then left out, as
+    many as the matches they are short of would make up, and the partition
+    is assigned again so that their matches go to the other cases. If that
+    still matches fewer cases of a partition than greedy assignment would,
+    the greedy picks are used for it.
+    Returns a list with the positions of the matches picked for each case.
+    """
+    taken = Bitmap.empty(len(match_pool["randomise"]))
+    if taken_positions is not None and len(taken_positions) > 0:
+        taken.add(taken_positions)
+
+    picked = {}
+    case_partitions = case_pool["partition"][case_positions]
+    order = np.argsort(case_partitions, kind="stable")
+    starts = np.flatnonzero(np.diff(case_partitions[order], prepend=-2) != 0)
+    for group in np.split(case_positions[order], starts[1:]):
+        if len(group) == 0:
+            continue
+        key = case_pool["partition"][group[0]]
+        candidates = []
+        costs = []
+        pool_sizes = []
+        case_seconds = []
+        for case_position in group:
+            if profiler is not None:
+                case_started = time.perf_counter()
+            if key not in partitions:
+                positions = np.zeros(0, dtype=np.int64)
+                pool_sizes.append(0)
+            else:
+                positions, _, _ = get_case_window(
+                    case_position,
+                    case_pool,
+                    partitions,
+                    range_values,
+                    range_variable,
+                    match_variables,
+                )
+                positions = get_eligible_positions(
+                    case_position,
+                    positions,
+                    case_pool,
+                    match_pool,
+                    match_variables,
+                    taken,
+                    range_variable,
+                    index_date_variable,
+                    date_exclusion_variables,
+                    replace_match_index_date_with_case,
+                    profiler,
+                )
+                pool_sizes.append(len(positions))
+            cost = np.zeros(len(positions))
+            for var in closest_match_variables or []:
+                cost = cost + np.abs(
+                    match_pool[var][positions] - case_pool[var][case_position]
+                )
+            candidates.append(positions)
+            costs.append(cost)
+            if profiler is not None:
+                case_seconds.append(time.perf_counter() - case_started)
+        if profiler is not None:
+            assign_started = time.perf_counter()
+
+        active = np.arange(len(group))
+        while len(active) > 0:
+            with profile_section(profiler, "assign_optimally"):
+                assigned = assign_optimally(
+                    [candidates[number] for number in active],
+                    [costs[number] for number in active],
+                    matches_per_case,
+                )
+            for number, positions in zip(active, assigned):
+                picked[group[number]] = positions
+            counts = np.array([len(positions) for positions in assigned])
+            short = np.flatnonzero((counts > 0) & (counts < min_matches_per_case))
+            if len(short) == 0:
+                break
+            ## Dropping every case that is short at once can leave too few
+            ## cases to use the matches, so only those furthest short are
+            shortfall = (min_matches_per_case - counts[short]).sum()
+            short = short[np.argsort(counts[short], kind="stable")]
+            dropped = short[: -(-shortfall // min_matches_per_case)]
+            for number in active[dropped]:
+                picked[group[number]] = np.zeros(0, dtype=np.int64)
+            active = np.delete(active, dropped)
+
+        ## Never match fewer of the partition's cases than greedy assignment
+        with profile_section(profiler, "greedy_check"):
+            greedy = match_case_positions(
+                group,
+                case_pool,
+                match_pool,
+                partitions,
+                range_values,
+                range_variable,
+                matches_per_case,
+                match_variables,
+                index_date_variable,
+                closest_match_variables,
+                date_exclusion_variables,
+                min_matches_per_case,
+                replace_match_index_date_with_case,
+                taken_positions,
+            )
+        minimum = max(min_matches_per_case, 1)
+        if sum(len(positions) >= minimum for positions in greedy) > sum(
+            len(picked[case_position]) >= minimum for case_position in group
+        ):
+            for case_position, positions in zip(group, greedy):
+                picked[case_position] = positions
+
+        if profiler is not None:
+            ## The assignment is shared between the partition's cases
+            assign_seconds = (time.perf_counter() - assign_started) / len(group)
+            for case_position, pool_size, seconds in zip(
+                group, pool_sizes, case_seconds
+            ):
+                profiler.record_case(
+                    case_position, key, pool_size, seconds + assign_seconds
+                )
+        if progress is not None:
+            progress(group[-1], len(group))
+
+    return [picked[case_position] for case_position in case_positions]
+
+
+## Arguments to match_case_positions shared by all tasks in a worker process
+WORKER_ARGS = {}
+
+
+def init_worker(kernel_args):
+    WORKER_ARGS.update(kernel_args)
+
+
+def run_worker_task(case_positions, profile=False):
+    if not profile:
+        return match_case_positions(case_positions, **WORKER_ARGS)
+    profiler = Profiler()
+    picked = match_case_positions(case_positions, profiler=profiler, **WORKER_ARGS)
+    return picked, profiler
+
+
+def split_partition_tasks(case_partitions, num_tasks):
+    """
+    Splits the case positions into roughly num_tasks tasks of similar size,
+    keeping all the cases of a partition in the same task. Cases in different
+    partitions never compete for the same matches, so the tasks can be run
+    independently. Each task's case positions are in ascending (matching)
+    order.
+    """
+    if len(case_partitions) == 0:
+        return []
+    order = np.argsort(case_partitions, kind="stable")
+    starts = np.flatnonzero(np.diff(case_partitions[order], prepend=-2) != 0)
+    groups = sorted(np.split(order, starts[1:]), key=len, reverse=True)
+    target_size = max(1, -(-len(case_partitions) // num_tasks))
+
+    tasks = []
+    task = []
+    task_size = 0
+    for group in groups:
+        task.append(group)
+        task_size += len(group)
+        if task_size >= target_size:
+            tasks.append(np.sort(np.concatenate(task)))
+            task = []
+            task_size = 0
+    if len(task) > 0:
+        tasks.append(np.sort(np.concatenate(task)))
+    return tasks
+
+
+def match_in_parallel(
+    workers,
+    kernel_args,
+    case_positions,
+    picked,
+    checkpoint=None,
+    progress=None,
+    profiler=None,
+):
+    """
+    Runs match_case_positions for the given cases over independent groups of
+    partitions in a pool of worker processes, and fills in their results in
+    picked, which is in case order. Where possible, workers are forked so that
+    they share the match pool arrays rather than each receiving a copy.
+    checkpoint, if given, is called with picked as each task finishes, and
+    progress with the last case position and number of cases in the task.
+    Each task is profiled separately if there is a profiler, and merged in.
+    """
+    case_partitions = kernel_args["case_pool"]["partition"][case_positions]
+    tasks = [
+        case_positions[task]
+        for task in split_partition_tasks(case_partitions, workers * 4)
+    ]
+    if "fork" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("fork")
+    else:
+        mp_context = None
+
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=mp_context,
+        initializer=init_worker,
+        initargs=(kernel_args,),
+    ) as executor:
+        results = executor.map(
+            run_worker_task, tasks, [profiler is not None] * len(tasks)
+        )
+        for task, task_picked in zip(tasks, results):
+            if profiler is not None:
+                task_picked, task_profiler = task_picked
+                profiler.merge(task_profiler)
+            for case_position, positions in zip(task, task_picked):
+                picked[case_position] = positions
+            if checkpoint is not None:
+                checkpoint(picked)
+            if progress is not None:
+                progress(task[-1], len(task))
+
+
+def match_cases_partitioned(
+    cases,
+    matches,
+    case_pool,
+    match_pool,
+    partitions,
+    range_values,
+    range_variable,
+    matches_per_case,
+    match_variables,
+    index_date_variable,
+    closest_match_variables=None,
+    date_exclusion_variables=None,
+    min_matches_per_case=0,
+    replace_match_index_date_with_case=None,
+    workers=1,
+    checkpoint_path=None,
+    checkpoint_every=None,
+    resume=False,
+    progress=None,
+    profiler=None,
+    assignment="greedy",
+    case_order=None,
+    picked=None,
+):
+    """
+    Runs match_case_positions for all cases, either directly or, if workers is
+    more than 1, spread over that many processes. Then records the number of
+    matches in cases["match_counts"] and labels the matches, in case order, so
+    the result is the same for any number of workers. matches can be None when
+    the match pool is shared, in which case only cases is updated.
+    With a checkpoint_path, the matches picked so far are saved there every
+    checkpoint_every cases (or, with workers, as each task finishes after
+    that many), and resume=True continues from the saved checkpoint, which
+    gives the same result as an uninterrupted run. progress, if given, is a
+    ProgressReporter that is called as cases are matched, and profiler a
+    Profiler that times each step. assignment is passed to
+    match_case_positions. case_order, if given, holds the case positions in
+    the order they are matched in, otherwise they are matched in case order.
+    picked, if given, is a list in case order that already holds the
+    positions picked by some cases (None for the others), which are kept as
+    if those cases had been matched first. It is filled in with the rest.
+    Returns the positions of the matches taken by each case that has enough,
+    and the positions of those cases.
+    """
+    kernel_args = dict(
+        case_pool=case_pool,
+        match_pool=match_pool,
+        partitions=partitions,
+        range_values=range_values,
+        range_variable=range_variable,
+        matches_per_case=matches_per_case,
+        match_variables=match_variables,
+        index_date_variable=index_date_variable,
+        closest_match_variables=closest_match_variables,
+        date_exclusion_variables=date_exclusion_variables,
+        min_matches_per_case=min_matches_per_case,
+        replace_match_index_date_with_case=replace_match_index_date_with_case,
+        assignment=assignment,
+    )
+    if case_order is None:
+        case_order = np.arange(len(cases), dtype=np.int64)
+    if picked is None:
+        picked = [None] * len(cases)
+    checkpoint = None
+    if checkpoint_path is not None:
+        fingerprint = get_fingerprint(
+            {
+                var: value
+                for var, value in kernel_args.items()
+                if var not in ("case_pool", "match_pool", "partitions", "range_values")
+            },
+            {
+                "case_id": cases.index.to_numpy(),
+                "case_order": case_order,
+                **{f"case:{var}": values for var, values in case_pool.items()},
+                **{f"match:{var}": values for var, values in match_pool.items()},
+            },
+        )
+        if resume:
+            saved = load_checkpoint(checkpoint_path, fingerprint, len(cases))
+            ## Filled in place, as the caller reads the picked positions
+            if saved is not None:
+                picked[:] = saved
+        last_saved = [sum(positions is not None for positions in picked)]
+
+        def checkpoint(picked, force=False):
+            done = sum(positions is not None for positions in picked)
+            if force or done - last_saved[0] >= (checkpoint_every or len(cases)):
+                save_checkpoint(checkpoint_path, fingerprint, picked)
+                last_saved[0] = done
+
+    ## Cases saved in a checkpoint come first in their partitions, so the rest
+    ## only need the matches those cases took
+    case_positions = np.array(
+        [position for position in case_order if picked[position] is None],
+        dtype=np.int64,
+    )
+    kernel_args["taken_positions"] = get_taken_positions(picked, min_matches_per_case)
+    if progress is not None:
+        progress.skip(len(cases) - len(case_positions))
+    if workers > 1:
+        match_in_parallel(
+            workers,
+            kernel_args,
+            case_positions,
+            picked,
+            checkpoint,
+            progress,
+            profiler,
+        )
+    else:
+        chunk_size = len(case_positions)
+        if checkpoint is not None and checkpoint_every is not None:
+            chunk_size = checkpoint_every
+        case_partitions = None
+        if assignment == "optimal":
+            ## Partitions are assigned as a whole, so chunks hold whole partitions
+            case_positions = case_positions[
+                np.argsort(case_pool["partition"][case_positions], kind="stable")
+            ]
+            case_partitions = case_pool["partition"][case_positions]
+        for chunk in split_into_chunks(case_positions, chunk_size, case_partitions):
+            for case_position, positions in zip(
+                chunk,
+                match_case_positions(
+                    chunk, progress=progress, profiler=profiler, **kernel_args
+                ),
+            ):
+                picked[case_position] = positions
+            if checkpoint is not None:
+                checkpoint(picked)
+            kernel_args["taken_positions"] = get_taken_positions(
+                picked, min_matches_per_case
+            )
+    if checkpoint is not None:
+        checkpoint(picked, force=True)
+
+    ## Record the number of matches for each case, as a float column as when
+    ## it was set case by case
+    counts = np.array([len(positions) for positions in picked], dtype=np.int64)
+    with profile_section(profiler, "bulk_write_back"):
+        cases["match_counts"] = counts.astype(np.float64)
+
+    ## Label matches with case ID if there are enough. set_id is only filled in
+    ## once all cases have been matched
+    taken_case_positions = np.flatnonzero(counts >= min_matches_per_case)
+    taken_positions = [picked[case_position] for case_position in taken_case_positions]
+
+    if matches is not None:
+        with profile_section(profiler, "bulk_write_back"):
+            ## Set index_date of the matches where needed
+            if replace_match_index_date_with_case is not None and len(cases) > 0:
+                assign_match_index_dates(
+                    matches,
+                    index_date_variable,
+                    taken_positions,
+                    get_match_index_date(
+                        cases[index_date_variable], replace_match_index_date_with_case
+                    ).iloc[taken_case_positions],
+                )
+            matches["set_id"] = materialise_set_ids(
+                len(matches), taken_positions, cases.index[taken_case_positions]
+            )
+    return taken_positions, taken_case_positions
+
+
+def assign_match_index_dates(
+    matches, index_date_variable, taken_positions, match_index_dates
+):
+    """
+    Gives the matches taken by each case (positions, one array per case) that
+    case's match_index_dates, in one assignment. Only the taken matches are
+    saved, so matches that were picked by a case without enough matches are
+    left alone. As when they were set case by case, dates set in an existing
+    column are stored as Timestamp objects, and a new column is a datetime
+    column.
+    """
+    positions = np.concatenate(list(taken_positions) + [np.zeros(0, dtype=np.int64)])
+    dates = np.repeat(
+        match_index_dates.to_numpy(dtype="datetime64[ns]"),
+        [len(case_positions) for case_positions in taken_positions],
+    )
+    if index_date_variable in matches.columns:
+        values = matches[index_date_variable].to_numpy(dtype=object, copy=True)
+        values[positions] = pd.Series(dates).astype(object).to_numpy()
+        ## Assigned as an object Series, as pandas infers a datetime column
+        ## from an object array of Timestamps and date text
+        values = pd.Series(values, index=matches.index, dtype=object)
+    else:
+        values = np.full(len(matches), np.datetime64("NaT"), dtype="datetime64[ns]")
+        values[positions] = dates
+    matches[index_date_variable] = values
+
+
+def split_into_chunks(case_positions, chunk_size, case_partitions=None):
+    """
+    Splits the case positions into chunks of chunk_size cases, which are
+    matched between checkpoints. If case_partitions (the partition of each
+    case, which must be grouped together) is given, chunks only end where the
+    partition changes, so they can be longer.
+    """
+    chunk_size = max(1, chunk_size)
+    if case_partitions is None:
+        return [
+            case_positions[start : start + chunk_size]
+            for start in range(0, len(case_positions), chunk_size)
+        ]
+    ends = np.append(
+        np.flatnonzero(np.diff(case_partitions) != 0) + 1, len(case_positions)
+    )
+    chunks = []
+    start = 0
+    for end in ends:
+        if end - start >= chunk_size or end == len(case_positions):
+            chunks.append(case_positions[start:end])
+            start = end
+    return chunks
+
+
+def reuse_unchanged_partitions(case_ids, case_keys, fingerprints, previous, match_ids):
+    """
+    For incremental matching, starts the list of picked positions (in case
+    order) from a previous result, loaded by load_matching_state. Cases in a
+    partition whose fingerprint is unchanged get the matches they picked
+    before, and the rest are None, to be matched. Returns the list and the
+    number of partitions reused.
+    """
+    picked = [None] * len(case_ids)
+    reused = {
+        key for key, fingerprint in fingerprints.items() if fingerprint in previous
+    }
+    if len(reused) == 0:
+        return picked, 0
+    match_index = pd.Index(match_ids)
+    for case_position, (case_id, key) in enumerate(zip(case_ids, case_keys)):
+        if key in reused:
+            picked[case_position] = match_index.get_indexer(
+                previous[fingerprints[key]][case_id]
+            ).astype(np.int64)
+    return picked, len(reused)
+
+
+def get_taken_positions(picked, min_matches_per_case=0):
+    """
+    Returns the positions of the matches taken so far, from the positions
+    picked for each case (None for cases not yet matched).
+    """
+    return np.concatenate(
+        [
+            positions
+            for positions in picked
+            if positions is not None and len(positions) >= min_matches_per_case
+        ]
+        + [np.zeros(0, dtype=np.int64)]
+    ).astype(np.int64)
+
+
+def materialise_set_ids(length, taken_positions, taken_set_ids):
+    """
+    Builds the set_id array for the match table from the positions of the
+    matches taken by each case and the set_id of that case. Matches that were
+    not taken are NOT_PREVIOUSLY_MATCHED.
+    """
+    set_ids = np.full(length, NOT_PREVIOUSLY_MATCHED, dtype=np.int64)
+    if len(taken_positions) > 0:
+        set_ids[np.concatenate(taken_positions)] = np.repeat(
+            taken_set_ids, [len(positions) for positions in taken_positions]
+        )
+    return set_ids
+
+
+def save_shared_match_pool(pool_dir, shared_pool):
+    """
+    Saves the arrays of a shared match pool as numbered .npy files in pool_dir,
+    with a pool.json listing them, so that they can be memory-mapped by
+    load_shared_match_pool. Categories are saved as pickled value arrays.
+    """
+    os.makedirs(pool_dir)
+    manifest = {
+        "arrays": [],
+        "categories": [],
+        "range_variable": shared_pool["range_variable"],
+        "has_index_date_column": shared_pool["has_index_date_column"],
+    }
+    arrays = [(f"pool:{var}", values) for var, values in shared_pool["pool"].items()]
+    arrays += [
+        (name, shared_pool[name])
+        for name in ("patient_id", "order", "partition_keys", "bounds", "sorted_values")
+        if shared_pool[name] is not None
+    ]
+    for number, (name, values) in enumerate(arrays):
+        np.save(os.path.join(pool_dir, f"{number}.npy"), values)
+        manifest["arrays"].append(name)
+    for var, values in shared_pool["categories"].items():
+        np.save(
+            os.path.join(pool_dir, f"{var}_categories.npy"),
+            np.asarray(values, dtype=object),
+            allow_pickle=True,
+        )
+        manifest["categories"].append(var)
+    with open(os.path.join(pool_dir, "pool.json"), "w") as f:
+        json.dump(manifest, f)
+
+
+def load_shared_match_pool(
+    pool_path,
+    match_csv_path,
+    match_variables,
+    index_date_variable,
+    closest_match_variables=None,
+    date_exclusion_variables=None,
+    replace_match_index_date_with_case=None,
+    date_format=None,
+    cache_path=None,
+    random_seed=None,
+    schema=None,
+):
+    """
+    Returns the encoded, sorted and partitioned match pool for match_csv_path,
+    so that concurrent or repeated runs against the same match csv can share
+    it. The first run builds it (from the matching columns only) and saves it
+    under pool_path, keyed on the csv's contents and the matching options.
+    Later runs memory-map the saved arrays read-only, so their pages are shared
+    between processes and only loaded as they are used.
+    The returned dict holds the match pool and categories as from
+    encode_matches, the partitions and range_values as from partition_matches,
+    the range_variable, the patient_id of each position, and whether the csv
+    has an index date column.
+    """
+    options = {
+        "match_variables": match_variables,
+        "index_date_variable": index_date_variable,
+        "closest_match_variables": closest_match_variables,
+        "date_exclusion_variables": date_exclusion_variables,
+        "keep_index_date": replace_match_index_date_with_case is None,
+        "version": SHARED_POOL_VERSION,
+        "date_format": date_format,
+        "random_seed": random_seed,
+        "schema": schema,
+    }
+    stem = os.path.splitext(os.path.basename(match_csv_path))[0]
+    prefix = f"{stem}-{hash_options(options)}-"
+    pool_dir = os.path.join(pool_path, prefix + hash_file(match_csv_path))
+
+    if not os.path.isdir(pool_dir):
+        encode_variables = copy.deepcopy(match_variables)
+        matches = import_csv(
+            match_csv_path,
+            encode_variables,
+            date_exclusion_variables,
+            index_date_variable,
+            replace_match_index_date_with_case is None,
+            closest_match_variables,
+            "matching",
+            date_format,
+            cache_path,
+            schema,
+        )
+        expand_month_only(encode_variables)
+        matches["randomise"] = get_randomise(matches.index, random_seed)
+        match_pool, categories = encode_matches(
+            matches,
+            encode_variables,
+            index_date_variable,
+            closest_match_variables,
+            date_exclusion_variables,
+            replace_match_index_date_with_case,
+        )
+        range_variable = get_range_variable(encode_variables, closest_match_variables)
+        order, partition_keys, bounds = sort_match_pool(match_pool, range_variable)
+        header = pd.read_csv(match_csv_path, nrows=0).columns
+        shared_pool = {
+            "pool": match_pool,
+            "categories": categories,
+            "range_variable": range_variable,
+            "has_index_date_column": index_date_variable in header,
+            "patient_id": matches.index.to_numpy(),
+            "order": order,
+            "partition_keys": partition_keys,
+            "bounds": bounds,
+            "sorted_values": None,
+        }
+        if range_variable is not None:
+            shared_pool["sorted_values"] = match_pool[range_variable][order]
+
+        save_keyed_dir(
+            pool_dir,
+            prefix,
+            match_csv_path,
+            lambda temp_dir: save_shared_match_pool(temp_dir, shared_pool),
+        )
+
+    with open(os.path.join(pool_dir, "pool.json")) as f:
+        manifest = json.load(f)
+    shared_pool = {
+        "path": pool_dir,
+        "pool": {},
+        "categories": {},
+        "range_variable": manifest["range_variable"],
+        "has_index_date_column": manifest["has_index_date_column"],
+        "sorted_values": None,
+    }
+    for number, name in enumerate(manifest["arrays"]):
+        values = np.load(os.path.join(pool_dir, f"{number}.npy"), mmap_mode="r")
+        if name.startswith("pool:"):
+            shared_pool["pool"][name[len("pool:") :]] = values
+        else:
+            shared_pool[name] = values
+    for var in manifest["categories"]:
+        shared_pool["categories"][var] = pd.Index(
+            np.load(os.path.join(pool_dir, f"{var}_categories.npy"), allow_pickle=True)
+        )
+    shared_pool["partitions"], shared_pool["range_values"] = split_partitions(
+        shared_pool["order"],
+        shared_pool["partition_keys"],
+        shared_pool["bounds"],
+        shared_pool["sorted_values"],
+    )
+    return shared_pool
+
+
+def read_shared_matches(
+    match_csv_path,
+    shared_pool,
+    taken_positions,
+    taken_set_ids,
+    match_variables,
+    index_date_variable,
+    date_exclusion_variables=None,
+    replace_match_index_date_with_case=None,
+    match_index_dates=None,
+    indicator_variable_name="case",
+    date_format=None,
+    schema=None,
+):
+    """
+    Builds the table of matched matches for a run against a shared match pool,
+    which has no match table, by reading the taken rows back from the csv.
+    shared_pool can also be a dict with just the patient_id, pool and
+    has_index_date_column of a match table that was not kept.
+    The table is laid out as the matched matches would be had the match csv
+    been imported, with set_id, randomise and the indicator variable added, and
+    the index date replaced with match_index_dates (one per taken row) where
+    replace_match_index_date_with_case is set.
+    """
+    set_ids = np.repeat(taken_set_ids, [len(p) for p in taken_positions])
+    positions = np.concatenate(taken_positions + [np.zeros(0, dtype=np.int64)])
+    row_order = np.argsort(positions, kind="stable")
+    positions = positions[row_order]
+
+    patient_ids = pd.Index(shared_pool["patient_id"][positions], name="patient_id")
+    if schema is None:
+        matched_matches = read_rows_by_id(match_csv_path, patient_ids)
+    else:
+        header = pd.read_csv(match_csv_path, nrows=0).columns
+        matched_matches = read_rows_by_id(
+            match_csv_path, patient_ids, dtype=get_schema_dtypes(schema, header)
+        )
+        matched_matches = set_schema_types(matched_matches, schema)
+    matched_matches = set_variable_types(
+        matched_matches,
+        match_variables,
+        date_exclusion_variables,
+        index_date_variable,
+        replace_match_index_date_with_case is None,
+        date_format,
+    )
+    matched_matches["set_id"] = set_ids[row_order]
+    matched_matches["randomise"] = shared_pool["pool"]["randomise"][positions]
+    matched_matches[indicator_variable_name] = 0
+    if replace_match_index_date_with_case is not None:
+        index_dates = pd.Series(
+            np.asarray(match_index_dates)[row_order], index=matched_matches.index
+        )
+        ## As when set with .loc, dates written into the imported column keep
+        ## it as object, while a new column is a datetime column
+        if shared_pool["has_index_date_column"]:
+            index_dates = index_dates.astype(object)
+        matched_matches[index_date_variable] = index_dates
+    return matched_matches
+
+
+def get_matching_report(report_path):
+    """
+    Returns a function that appends lines of text to the report at
+    report_path, printing them unless echo is False. erase=True starts a new
+    report.
+    """
+
+    def matching_report(text_to_write, erase=False, echo=True):
+        if erase and os.path.isfile(report_path):
+            os.remove(report_path)
+        with open(report_path, "a") as txt:
+            for line in text_to_write:
+                txt.writelines(f"{line}\n")
+                if echo:
+                    print(line)
+            txt.writelines("\n")
+            if echo:
+                print("\n")
+
+    return matching_report
+
+
+def get_variable_kinds(match_variables):
+    """
+    Returns how each match variable is matched, without the tolerances of
+    those with one, which can differ between runs on the same populations.
+    """
+    return {
+        var: "tolerance" if isinstance(match_type, int) else match_type
+        for var, match_type in match_variables.items()
+    }
+
+
+def prepare_populations(
+    case_csv,
+    match_csv,
+    match_variables,
+    index_date_variable,
+    closest_match_variables=None,
+    date_exclusion_variables=None,
+    replace_match_index_date_with_case=None,
+    indicator_variable_name="case",
+    output_path="output",
+    engine="partitioned",
+    import_columns="all",
+    date_format=None,
+    cache_path=None,
+    pool_path=None,
+    random_seed=None,
+    schema=None,
+    matching_report=print,
+    timer=None,
+):
+    """
+    Does everything match() does before the matching loop: imports the csvs
+    (or loads the shared match pool), drops the cases from the matches, adds
+    set_id and randomise, makes the date exclusions for cases, sorts the cases
+    by index date and builds the engine's indices. Returns a dict of the
+    results, which match_populations only reads, so that it can be matched
+    several times. The steps are written with matching_report and timed with
+    timer.
+    """
+    timer = timer or PhaseTimer()
+    if schema is not None:
+        schema = get_schema(schema)
+
+    ## Deep copy match_variables
+    match_variables = copy.deepcopy(match_variables)
+    import_variables = copy.deepcopy(match_variables)
+    case_path = os.path.join(output_path, f"{case_csv}.csv")
+    match_path = os.path.join(output_path, f"{match_csv}.csv")
+
+    ## Load the shared match pool, which can only be used if no cases need to
+    ## be dropped from it
+    shared_pool = None
+    if pool_path is not None:
+        if engine != "partitioned":
+            raise Exception("A shared match pool needs the partitioned engine")
+        shared_pool = load_shared_match_pool(
+            pool_path,
+            match_path,
+            import_variables,
+            index_date_variable,
+            closest_match_variables,
+            date_exclusion_variables,
+            replace_match_index_date_with_case,
+            date_format,
+            cache_path,
+            random_seed,
+            schema,
+        )
+        cases = import_csv(
+            case_path,
+            match_variables,
+            date_exclusion_variables,
+            index_date_variable,
+            True,
+            closest_match_variables,
+            import_columns,
+            date_format,
+            cache_path,
+            schema,
+        )
+        if np.isin(cases.index, shared_pool["patient_id"]).any():
+            matching_report(
+                ["Cases are in the shared match pool, so it will not be used"]
+            )
+            shared_pool = None
+            match_variables = copy.deepcopy(import_variables)
+
+    ## Import_data
+    if shared_pool is None:
+        cases, matches = import_csvs(
+            case_csv,
+            match_csv,
+            match_variables,
+            date_exclusion_variables,
+            index_date_variable,
+            output_path,
+            replace_match_index_date_with_case,
+            closest_match_variables,
+            import_columns,
+            date_format,
+            cache_path,
+            schema,
+        )
+        pool_size = len(matches)
+    else:
+        expand_month_only(match_variables)
+        matches = None
+        pool_size = len(shared_pool["patient_id"])
+
+    matching_report(
+        [
+            f"CSV import ({import_columns} columns):",
+            f"Completed {datetime.now()}",
+            f"Cases    {len(cases)}",
+            f"Matches  {pool_size}",
+        ]
+        + ([] if shared_pool is None else [f"Shared match pool {shared_pool['path']}"]),
+    )
+    timer.end_phase("import")
+
+    if shared_pool is None:
+        ## Drop cases from match population
+        ## WARNING - this will cause issues in dummy data where population
+        ## sizes are the same, as the indices will be identical.
+        matches = matches.drop(cases.index, errors="ignore")
+        pool_size = len(matches)
+
+        matching_report(
+            [
+                "Dropping cases from matches:",
+                f"Completed {datetime.now()}",
+                f"Cases    {len(cases)}",
+                f"Matches  {pool_size}",
+            ]
+        )
+
+        ## Add set_id and randomise variables
+        cases, matches = add_variables(
+            cases, matches, indicator_variable_name, random_seed
+        )
+    else:
+        ## As in add_variables, randomise being in the shared match pool
+        cases["set_id"] = cases.index
+        cases[indicator_variable_name] = 1
+    timer.end_phase("drop")
+
+    populations = {
+        "cases": None,
+        "matches": matches,
+        "pool_size": pool_size,
+        "shared_pool": shared_pool,
+        "match_variables": match_variables,
+        "import_variables": import_variables,
+        "case_path": case_path,
+        "match_path": match_path,
+        "indices": None,
+        "match_rows": None,
+        "schema": schema,
+        "random_seed": random_seed,
+    }
+
+    if engine == "reference":
+        populations["indices"] = pre_calculate_indices(cases, matches, match_variables)
+        index_bytes = sum(
+            bitmap.nbytes
+            for variable_indices in populations["indices"].values()
+            for bitmap in variable_indices.values()
+        )
+        matching_report(
+            [
+                f"Completed pre-calculating indices at {datetime.now()}",
+                f"Index size {index_bytes / 1e6:.1f} MB",
+            ]
+        )
+        timer.end_phase("index_build")
+    elif engine != "partitioned":
+        raise Exception(f"Matching engine '{engine}' not implemented")
 
     if date_exclusion_variables is not None:
         case_exclusions = date_exclusions(
@@ -304,63 +2414,412 @@ def match(
                 "Date exclusions for cases:",
                 f"Completed {datetime.now()}",
                 f"Cases    {len(cases)}",
-                f"Matches  {len(matches)}",
+                f"Matches  {pool_size}",
             ]
         )
 
-    ## Sort cases by index date
-    cases = cases.sort_values(index_date_variable)
+    ## Sort cases by index date, keeping the csv order of cases with the same
+    ## date, so each partition's case order does not depend on other cases
+    cases = cases.sort_values(index_date_variable, kind="stable")
+    populations["cases"] = cases
+    timer.end_phase("case_exclusions")
 
-    for case_id, case_row in cases.iterrows():
-        ## Get eligible matches
-        eligible_matches = get_eligible_matches(
-            case_row, matches, match_variables, indices
+    if engine == "reference":
+        return populations
+
+    if shared_pool is not None:
+        populations["match_ids"] = shared_pool["patient_id"]
+        populations["match_pool"] = shared_pool["pool"]
+        populations["partitions"] = shared_pool["partitions"]
+        populations["range_values"] = shared_pool["range_values"]
+        populations["range_variable"] = shared_pool["range_variable"]
+        populations["case_pool"] = encode_cases(
+            cases,
+            shared_pool["categories"],
+            match_variables,
+            index_date_variable,
+            closest_match_variables,
+            replace_match_index_date_with_case,
+        )
+        matching_report(
+            [
+                f"Completed encoding cases at {datetime.now()}",
+                f"Partitions {len(populations['partitions'])}",
+                f"Range variable {populations['range_variable']}",
+            ]
+        )
+    else:
+        populations["match_ids"] = matches.index.to_numpy()
+        populations["case_pool"], populations["match_pool"] = encode_match_pool(
+            cases,
+            matches,
+            match_variables,
+            index_date_variable,
+            closest_match_variables,
+            date_exclusion_variables,
+            replace_match_index_date_with_case,
+        )
+        populations["range_variable"] = get_range_variable(
+            match_variables, closest_match_variables
+        )
+        (
+            populations["partitions"],
+            populations["range_values"],
+        ) = partition_matches(populations["match_pool"], populations["range_variable"])
+        matching_report(
+            [
+                f"Completed encoding and partitioning matches at {datetime.now()}",
+                f"Partitions {len(populations['partitions'])}",
+                f"Range variable {populations['range_variable']}",
+            ]
         )
-        matched_rows = matches.loc[eligible_matches]
+        if import_columns == "matching":
+            ## The matched rows are read back from the csv in full, as from a
+            ## shared match pool, so the match table is not kept once encoded
+            populations["match_rows"] = {
+                "patient_id": populations["match_ids"],
+                "pool": populations["match_pool"],
+                "has_index_date_column": index_date_variable in matches.columns,
+            }
+            populations["matches"] = None
+    timer.end_phase("index_build")
+    return populations
 
-        ## Determine match index date
-        if replace_match_index_date_with_case is None:
-            index_date = matched_rows[index_date_variable]
-        else:
-            if offset_str == "no_offset":
-                index_date = case_row[index_date_variable]
-            elif offset_str.split("_")[2] == "earlier":
-                index_date = case_row[index_date_variable] - date_offset
-            elif offset_str.split("_")[2] == "later":
-                index_date = case_row[index_date_variable] + date_offset
-            else:
-                raise Exception(f"Date offset type '{offset_str}' not recognised")
 
-        ## Index date based match exclusions (faster to do this after get_eligible_matches)
-        if date_exclusion_variables is not None:
-            exclusions = date_exclusions(
-                matched_rows, date_exclusion_variables, index_date
+def reseed_populations(populations, random_seed):
+    """
+    Returns a copy of populations from prepare_populations with the randomise
+    variable for random_seed, and the partitions sorted on it again, as if
+    they had been prepared with random_seed. randomise only depends on the
+    seed and the match pool's patient_ids, so nothing needs to be imported
+    again. The tables that do not change are shared, not copied.
+    """
+    populations = dict(populations, random_seed=random_seed)
+    if populations["matches"] is not None:
+        randomise = get_randomise(populations["matches"].index, random_seed)
+        populations["matches"] = populations["matches"].assign(randomise=randomise)
+    if "match_pool" not in populations:
+        return populations
+
+    match_pool = dict(populations["match_pool"])
+    match_pool["randomise"] = get_randomise(populations["match_ids"], random_seed)
+    populations["match_pool"] = match_pool
+    populations["partitions"], populations["range_values"] = partition_matches(
+        match_pool, populations["range_variable"]
+    )
+    ## The matched rows read back from the csv take randomise from the pool
+    for rows in ("shared_pool", "match_rows"):
+        if populations[rows] is not None:
+            populations[rows] = dict(populations[rows], pool=match_pool)
+    return populations
+
+
+def match_populations(
+    populations,
+    matches_per_case,
+    match_variables,
+    index_date_variable,
+    closest_match_variables=None,
+    date_exclusion_variables=None,
+    min_matches_per_case=0,
+    replace_match_index_date_with_case=None,
+    indicator_variable_name="case",
+    output_suffix="",
+    output_path="output",
+    engine="partitioned",
+    workers=1,
+    import_columns="all",
+    date_format=None,
+    checkpoint_every=None,
+    resume=False,
+    progress_interval=60,
+    profile=False,
+    output_format="csv",
+    combined_output=True,
+    output_compression=None,
+    assignment="greedy",
+    case_order="index_date",
+    incremental=False,
+    output_shards=None,
+    shard_by="set_id",
+    random_seed=None,
+    matching_report=print,
+    timer=None,
+    metrics=None,
+):
+    """
+    Does everything match() does from the matching loop on, for populations
+    from prepare_populations: matches the cases, and saves the matched
+    tables, the report and the metrics with output_suffix. match_variables
+    can have other tolerances than those the populations were prepared with,
+    and random_seed another seed, see reseed_populations. populations is not
+    changed, so it can be matched again with other options. metrics, a dict,
+    is saved along with those of the run.
+    """
+    timer = timer or PhaseTimer()
+    if random_seed != populations["random_seed"]:
+        populations = reseed_populations(populations, random_seed)
+    metrics_path = os.path.join(
+        output_path,
+        f"matching_metrics{output_suffix}.json",
+    )
+    profile_path = os.path.join(
+        output_path,
+        f"matching_profile{output_suffix}.json",
+    )
+    checkpoint_path = None
+    if checkpoint_every is not None or resume:
+        if engine != "partitioned":
+            raise Exception("Checkpoints need the partitioned engine")
+        checkpoint_path = os.path.join(
+            output_path, f"matching_checkpoint{output_suffix}.npz"
+        )
+
+    match_variables = copy.deepcopy(match_variables)
+    expand_month_only(match_variables)
+    if get_variable_kinds(match_variables) != get_variable_kinds(
+        populations["match_variables"]
+    ):
+        raise Exception(
+            "The match variables, and how they are matched, must be those the "
+            "populations were prepared with"
+        )
+    shared_pool = populations["shared_pool"]
+    ## Where there is no match table, the matched rows are read from the csv
+    match_rows = shared_pool if shared_pool is not None else populations["match_rows"]
+    pool_size = populations["pool_size"]
+    import_variables = populations["import_variables"]
+    case_path = populations["case_path"]
+    match_path = populations["match_path"]
+
+    ## Matching writes match_counts, set_id and the index date, so those are
+    ## given fresh columns in shallow copies of the tables
+    cases = populations["cases"].copy(deep=False)
+    matches = populations["matches"]
+    if matches is not None:
+        matches = matches.copy(deep=False)
+        for column in ("set_id", index_date_variable):
+            if column in matches.columns:
+                matches[column] = matches[column].to_numpy(copy=True)
+
+    ## Progress lines name the case's partition by its exact match values
+    exact_variables = [
+        var for var, match_type in match_variables.items() if match_type == "category"
+    ]
+
+    def describe_case(case_position):
+        return ", ".join(
+            f"{var}={cases[var].iat[case_position]}" for var in exact_variables
+        )
+
+    ## Count the matches available to each case, so that a lack of them shows
+    ## up before matching
+    supply = {}
+    matching_order = None
+    if engine == "partitioned":
+        candidate_counts = count_candidates(
+            populations["case_pool"],
+            populations["partitions"],
+            populations["range_values"],
+            populations["range_variable"],
+            match_variables,
+        )
+        supply = summarise_supply(
+            candidate_counts, matches_per_case, min_matches_per_case
+        )
+        matching_report(
+            [
+                f"Supply pre-scan (matches in each case's partition and range "
+                f"window) completed at {datetime.now()}",
+                f"Cases with no matches available  {supply['cases_without_candidates']}",
+                f"Cases with fewer than {matches_per_case} available  "
+                f"{supply['cases_below_matches_per_case']}",
+            ]
+            + (
+                [
+                    f"Cases with fewer than {min_matches_per_case} available  "
+                    f"{supply['cases_below_min_matches_per_case']}"
+                ]
+                if min_matches_per_case > 0
+                else []
             )
-            matched_rows = matched_rows.loc[~exclusions]
+            + [
+                "Available matches per case:",
+                pd.Series(candidate_counts).describe().to_string(),
+            ]
+        )
+        if case_order == "scarcity":
+            ## Cases with the fewest available matches pick first, ties in
+            ## index date order
+            matching_order = np.argsort(candidate_counts, kind="stable")
+        timer.end_phase("supply_scan")
 
-        ## Pick random matches
-        matched_rows = greedily_pick_matches(
+    ## Reuse the previous result for the partitions whose inputs are unchanged
+    picked = None
+    if incremental:
+        state_path = os.path.join(output_path, f"matching_state{output_suffix}.npz")
+        fingerprints = get_partition_fingerprints(
+            {
+                "matches_per_case": matches_per_case,
+                "match_variables": match_variables,
+                "index_date_variable": index_date_variable,
+                "closest_match_variables": closest_match_variables,
+                "date_exclusion_variables": date_exclusion_variables,
+                "min_matches_per_case": min_matches_per_case,
+                "replace_match_index_date_with_case": replace_match_index_date_with_case,
+                "range_variable": populations["range_variable"],
+                "assignment": assignment,
+            },
+            cases.index.to_numpy(),
+            populations["case_pool"],
+            populations["match_ids"],
+            populations["match_pool"],
+            populations["partitions"],
+            np.arange(len(cases)) if matching_order is None else matching_order,
+        )
+        picked, reused = reuse_unchanged_partitions(
+            cases.index,
+            populations["case_pool"]["partition"],
+            fingerprints,
+            load_matching_state(state_path),
+            populations["match_ids"],
+        )
+        matching_report(
+            [
+                f"Incremental matching: reusing {reused} of {len(fingerprints)} "
+                f"partitions, {sum(positions is not None for positions in picked)} "
+                f"of {len(cases)} cases",
+            ]
+        )
+        timer.end_phase("incremental_scan")
+
+    progress = ProgressReporter(
+        len(cases), matching_report, describe_case, progress_interval
+    )
+    profiler = Profiler() if profile else None
+
+    if engine == "reference":
+        indices = populations["indices"]
+        if match_variables != populations["match_variables"]:
+            ## Indices of variables with a tolerance depend on it
+            indices = pre_calculate_indices(cases, matches, match_variables)
+        match_cases_reference(
+            cases,
+            matches,
             matches_per_case,
-            matched_rows,
-            case_row,
+            match_variables,
+            indices,
+            index_date_variable,
             closest_match_variables,
+            date_exclusion_variables,
+            min_matches_per_case,
+            replace_match_index_date_with_case,
+            progress,
+            profiler,
         )
+    else:
+        taken_positions, taken_case_positions = match_cases_partitioned(
+            cases,
+            matches,
+            populations["case_pool"],
+            populations["match_pool"],
+            populations["partitions"],
+            populations["range_values"],
+            populations["range_variable"],
+            matches_per_case,
+            match_variables,
+            index_date_variable,
+            closest_match_variables,
+            date_exclusion_variables,
+            min_matches_per_case,
+            replace_match_index_date_with_case,
+            workers,
+            checkpoint_path,
+            checkpoint_every,
+            resume,
+            progress,
+            profiler,
+            assignment,
+            matching_order,
+            picked,
+        )
+        if incremental:
+            save_matching_state(
+                state_path,
+                cases.index,
+                [fingerprints[key] for key in populations["case_pool"]["partition"]],
+                [populations["match_ids"][positions] for positions in picked],
+            )
 
-        ## Report number of matches for each case
-        num_matches = len(matched_rows)
-        cases.loc[case_id, "match_counts"] = num_matches
-
-        ## Label matches with case ID if there are enough
-        if num_matches >= min_matches_per_case:
-            matches.loc[matched_rows, "set_id"] = case_id
+    loop_seconds = timer.end_phase("loop")
+    matching_report(
+        [
+            f"Completed matching at {datetime.now()}",
+            f"Matching took {timedelta(seconds=round(loop_seconds))}, "
+            f"{len(cases) / max(loop_seconds, 1e-9):.1f} cases/s",
+        ]
+    )
 
-        ## Set index_date of the match where needed
-        if replace_match_index_date_with_case is not None:
-            matches.loc[matched_rows, index_date_variable] = index_date
+    if profiler is not None:
+        profiler.save(profile_path, describe_case)
+        matching_report([f"Saved matching profile to {profile_path}"])
 
     ## Drop unmatched cases/matches
     matched_cases = cases.loc[cases["match_counts"] >= min_matches_per_case]
-    matched_matches = matches.loc[matches["set_id"] != NOT_PREVIOUSLY_MATCHED]
+    if match_rows is not None:
+        match_index_dates = None
+        if replace_match_index_date_with_case is not None:
+            match_index_dates = np.repeat(
+                get_match_index_date(
+                    cases[index_date_variable], replace_match_index_date_with_case
+                ).to_numpy()[taken_case_positions],
+                [len(positions) for positions in taken_positions],
+            )
+        matched_matches = read_shared_matches(
+            match_path,
+            match_rows,
+            taken_positions,
+            cases.index[taken_case_positions],
+            import_variables,
+            index_date_variable,
+            date_exclusion_variables,
+            replace_match_index_date_with_case,
+            match_index_dates,
+            indicator_variable_name,
+            date_format,
+            populations["schema"],
+        )
+    else:
+        matched_matches = matches.loc[matches["set_id"] != NOT_PREVIOUSLY_MATCHED]
+
+    ## Add back the columns not needed for matching
+    if import_columns == "matching":
+        date_variables = list(date_exclusion_variables or [])
+        replaced_variables = []
+        if replace_match_index_date_with_case is None:
+            match_date_variables = date_variables + [index_date_variable]
+        else:
+            match_date_variables = date_variables
+            replaced_variables.append(index_date_variable)
+        matched_cases = pull_back_columns(
+            matched_cases,
+            case_path,
+            date_variables + [index_date_variable],
+            date_format=date_format,
+            schema=populations["schema"],
+        )
+        ## Matches without a match table are always read back in full
+        if match_rows is None:
+            matched_matches = pull_back_columns(
+                matched_matches,
+                match_path,
+                match_date_variables,
+                replaced_variables,
+                date_format=date_format,
+                schema=populations["schema"],
+            )
+        matching_report([f"Completed reading back other columns at {datetime.now()}"])
+    timer.end_phase("read_back")
 
     ## Describe population differences
     scalar_comparisons = compare_populations(
@@ -379,13 +2838,342 @@ def match(
         + scalar_comparisons
     )
 
-    ## Write to csvs
-    matched_cases.to_csv(os.path.join(output_path, f"matched_cases{output_suffix}.csv"))
-    matched_matches.to_csv(
-        os.path.join(output_path, f"matched_matches{output_suffix}.csv")
+    ## Write to csvs, or another output_format
+    write_matched_outputs(
+        matched_cases,
+        matched_matches,
+        output_path,
+        output_suffix,
+        output_format,
+        combined_output,
+        output_compression,
+        output_shards,
+        shard_by,
+    )
+
+    timer.end_phase("write")
+    timer.save(
+        metrics_path,
+        engine=engine,
+        workers=workers,
+        cases=len(cases),
+        matches=pool_size,
+        matched_cases=len(matched_cases),
+        matched_matches=len(matched_matches),
+        loop_cases_per_second=len(cases) / max(loop_seconds, 1e-9),
+        case_order=case_order,
+        supply=supply,
+        **(metrics or {}),
+    )
+
+    ## The checkpoint is no longer needed once the results are saved
+    if checkpoint_path is not None and os.path.isfile(checkpoint_path):
+        os.remove(checkpoint_path)
+
+
+def check_match_options(
+    matches_per_case,
+    min_matches_per_case=0,
+    engine="partitioned",
+    assignment="greedy",
+    case_order="index_date",
+    incremental=False,
+    output_shards=None,
+):
+    """
+    Checks the options of match() that are not checked as they are used, or
+    are only used once matching is done.
+    """
+    assert (
+        min_matches_per_case <= matches_per_case
+    ), "min_matches_per_case cannot be greater than matches_per_case"
+    if assignment not in ("greedy", "optimal"):
+        raise Exception(f"Assignment '{assignment}' not implemented")
+    if assignment == "optimal" and engine != "partitioned":
+        raise Exception("Optimal assignment needs the partitioned engine")
+    if case_order not in ("index_date", "scarcity"):
+        raise Exception(f"Case order '{case_order}' not implemented")
+    if case_order == "scarcity" and engine != "partitioned":
+        raise Exception("Scarcity case order needs the partitioned engine")
+    if incremental and engine != "partitioned":
+        raise Exception("Incremental matching needs the partitioned engine")
+    if output_shards is not None and (
+        not isinstance(output_shards, int) or output_shards < 1
+    ):
+        raise Exception("output_shards must be a positive integer")
+
+
+def match(
+    case_csv,
+    match_csv,
+    matches_per_case,
+    match_variables,
+    index_date_variable,
+    closest_match_variables=None,
+    date_exclusion_variables=None,
+    min_matches_per_case=0,
+    replace_match_index_date_with_case=None,
+    indicator_variable_name="case",
+    output_suffix="",
+    output_path="output",
+    engine="partitioned",
+    workers=1,
+    import_columns="all",
+    date_format=None,
+    cache_path=None,
+    pool_path=None,
+    checkpoint_every=None,
+    resume=False,
+    progress_interval=60,
+    profile=False,
+    output_format="csv",
+    combined_output=True,
+    output_compression=None,
+    assignment="greedy",
+    random_seed=None,
+    case_order="index_date",
+    incremental=False,
+    schema=None,
+    output_shards=None,
+    shard_by="set_id",
+):
+    """
+    Wrapper function that calls functions to:
+    - import data
+      - schema, a study definition's path or a schema from
+        study_schema.extract_schema, reads each column of the csvs that is in
+        it as its type (small integers for flags and counts, categories, and
+        parsed dates) rather than as pandas infers them
+    - find eligible matches
+      - engine="partitioned" groups the matches by the exact match variables
+        once and only searches the case's own partition
+      - engine="reference" compares each case against the whole match table
+      - with the partitioned engine, workers > 1 matches independent
+        partitions in that many processes, with the same result
+      - import_columns="matching" only imports the columns needed to match,
+        and reads the rest back for the matched patients when saving. With
+        the partitioned engine the match table is not kept once it is
+        encoded, so the memory used grows with the number of match variables
+        rather than the width of the csvs
+      - cache_path keeps a binary copy of the imported columns that later runs
+        on the same csvs load instead
+      - pool_path keeps the encoded and partitioned matches there, which
+        concurrent and later runs against the same match csv memory-map and
+        share instead of importing it (when no cases are in the match csv)
+      - with the partitioned engine, checkpoint_every saves the matching done
+        so far to the output folder every that many cases, and resume=True
+        continues from there, with the same result as an uninterrupted run
+      - with the partitioned engine, incremental=True saves the result with a
+        fingerprint of each partition's inputs to
+        matching_state{output_suffix}.npz, and the next incremental run only
+        matches the partitions whose fingerprint changed, reusing the saved
+        matches for the rest, with the same result as a full run. Without a
+        random_seed, adding or removing rows of the match csv (or cases that
+        are also in it) changes the randomise values of the rows after them,
+        and so the fingerprints of most partitions too
+    - with the partitioned engine, count the matches available to each case
+      before matching and report how many cases are short of them
+    - report progress every progress_interval seconds while matching, and save
+      the time taken by each phase to matching_metrics{output_suffix}.json
+    - profile=True times each step of the matching loop and saves the times,
+      a histogram of the time per case and the slowest cases to
+      matching_profile{output_suffix}.json
+    - pick the correct number of randomly allocated matches
+      - ties are broken by the randomise variable, which by default is drawn
+        in the row order of the match csv. With a random_seed it is derived
+        from the seed and each patient_id instead, so that the same matches
+        are picked however the csv is ordered or split
+      - assignment="greedy" picks the closest matches for each case in turn,
+        in index date order, or with case_order="scarcity" (partitioned
+        engine) starting with the cases that have the fewest matches
+        available
+      - assignment="optimal" (partitioned engine, needs scipy) assigns the
+        matches of each partition to all its cases at once, matching as many
+        cases as possible with the smallest total distance on the
+        closest_match_variables
+    - make exclusions that are based on index date
+      - (this is not currently possible in a study definition, and will only ever be possible
+        during matching for studies where the match index date comes from the case)
+    - set the set_id as that of the case_id (this excludes them from being matched later)
+    - set the index date of the match as that of the case (where desired)
+    - save the results as a csv
+      - or as parquet or feather with output_format, compressed with
+        output_compression, and without matched_combined if combined_output
+        is False
+      - output_shards saves each file as that many shards, split by the
+        shard_by column ("set_id", which keeps each matched set together, or
+        "practice_id"), listed in matched_manifest{output_suffix}.json, so
+        that later steps can read the shards in parallel or only those they
+        need
+    To run several matchings of the same csvs, see match_many.
+    """
+    check_match_options(
+        matches_per_case,
+        min_matches_per_case,
+        engine,
+        assignment,
+        case_order,
+        incremental,
+        output_shards,
+    )
+    matching_report = get_matching_report(
+        os.path.join(output_path, f"matching_report{output_suffix}.txt")
+    )
+    matching_report(
+        [f"Matching started at: {datetime.now()}"],
+        erase=True,
+    )
+    timer = PhaseTimer()
+
+    populations = prepare_populations(
+        case_csv=case_csv,
+        match_csv=match_csv,
+        match_variables=match_variables,
+        index_date_variable=index_date_variable,
+        closest_match_variables=closest_match_variables,
+        date_exclusion_variables=date_exclusion_variables,
+        replace_match_index_date_with_case=replace_match_index_date_with_case,
+        indicator_variable_name=indicator_variable_name,
+        output_path=output_path,
+        engine=engine,
+        import_columns=import_columns,
+        date_format=date_format,
+        cache_path=cache_path,
+        pool_path=pool_path,
+        random_seed=random_seed,
+        schema=schema,
+        matching_report=matching_report,
+        timer=timer,
+    )
+    match_populations(
+        populations,
+        matches_per_case=matches_per_case,
+        match_variables=match_variables,
+        index_date_variable=index_date_variable,
+        closest_match_variables=closest_match_variables,
+        date_exclusion_variables=date_exclusion_variables,
+        min_matches_per_case=min_matches_per_case,
+        replace_match_index_date_with_case=replace_match_index_date_with_case,
+        indicator_variable_name=indicator_variable_name,
+        output_suffix=output_suffix,
+        output_path=output_path,
+        engine=engine,
+        workers=workers,
+        import_columns=import_columns,
+        date_format=date_format,
+        checkpoint_every=checkpoint_every,
+        resume=resume,
+        progress_interval=progress_interval,
+        profile=profile,
+        output_format=output_format,
+        combined_output=combined_output,
+        output_compression=output_compression,
+        assignment=assignment,
+        case_order=case_order,
+        incremental=incremental,
+        output_shards=output_shards,
+        shard_by=shard_by,
+        random_seed=random_seed,
+        matching_report=matching_report,
+        timer=timer,
+    )
+
+
+def match_many(configs, **options):
+    """
+    Runs match() once for each of configs, but imports and indexes the csvs
+    only once. Each config is a dict of options for match(), which are added
+    to, and override, those given as keyword arguments. The configs can
+    differ in the options that only affect matching and saving, such as
+    matches_per_case, min_matches_per_case, the tolerances in match_variables,
+    random_seed, assignment and the output options, but must agree on
+    POPULATION_OPTIONS and on the match variables and how they are matched.
+    Each config needs its own output_suffix, which its results, report and
+    metrics are saved with. The report of each config starts with that of the shared import,
+    and its metrics hold the shared phase times as shared_phase_seconds.
+    """
+    ## With the defaults of match() filled in, so that they can be compared
+    signature = inspect.signature(match)
+    configs = [signature.bind(**{**options, **config}) for config in configs]
+    for config in configs:
+        config.apply_defaults()
+    configs = [config.arguments for config in configs]
+    if len(configs) == 0:
+        return
+    suffixes = [config["output_suffix"] for config in configs]
+    if len(set(suffixes)) < len(suffixes):
+        raise Exception("Each configuration needs a different output_suffix")
+    first = configs[0]
+    for config in configs:
+        for option in POPULATION_OPTIONS:
+            if config[option] != first[option]:
+                raise Exception(
+                    f"Option '{option}' must be the same for all configurations"
+                )
+        if get_variable_kinds(config["match_variables"]) != get_variable_kinds(
+            first["match_variables"]
+        ):
+            raise Exception(
+                "The match variables, and how they are matched, must be the same "
+                "for all configurations"
+            )
+        check_match_options(
+            config["matches_per_case"],
+            config["min_matches_per_case"],
+            config["engine"],
+            config["assignment"],
+            config["case_order"],
+            config["incremental"],
+            config["output_shards"],
+        )
+
+    ## The shared steps are reported once, and copied into each config's report
+    shared_lines = []
+
+    def shared_report(text_to_write):
+        shared_lines.append(text_to_write)
+        for line in text_to_write:
+            print(line)
+        print("\n")
+
+    shared_report(
+        [f"Matching {len(configs)} configurations started at: {datetime.now()}"]
     )
-    appended = matched_cases.append(matched_matches)
-    appended.to_csv(os.path.join(output_path, f"matched_combined{output_suffix}.csv"))
+    shared_timer = PhaseTimer()
+    populations = prepare_populations(
+        **{option: first[option] for option in POPULATION_OPTIONS},
+        match_variables=first["match_variables"],
+        random_seed=first["random_seed"],
+        matching_report=shared_report,
+        timer=shared_timer,
+    )
+
+    for config in configs:
+        output_suffix = config["output_suffix"]
+        matching_report = get_matching_report(
+            os.path.join(config["output_path"], f"matching_report{output_suffix}.txt")
+        )
+        for number, text_to_write in enumerate(shared_lines):
+            matching_report(text_to_write, erase=number == 0, echo=False)
+        matching_report([f"Matching {output_suffix or 'run'} at: {datetime.now()}"])
+        match_populations(
+            populations,
+            **{
+                option: value
+                for option, value in config.items()
+                if option
+                not in (
+                    "case_csv",
+                    "match_csv",
+                    "cache_path",
+                    "pool_path",
+                    "schema",
+                )
+            },
+            matching_report=matching_report,
+            timer=PhaseTimer(),
+            metrics={"shared_phase_seconds": shared_timer.durations},
+        )
 
 
 def compare_populations(matched_cases, matched_matches, closest_match_variables):
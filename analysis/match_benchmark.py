@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import filecmp
+import argparse
+import numpy as np
+import pandas as pd
+
+from match import match
+from match_baseline import match as baseline_match
+
+## Numbers of controls generated by default. The largest is about the size of
+## the general population extract.
+DEFAULT_SIZES = [10000, 100000, 1000000, 12000000]
+
+## Matching as in match_running.py, with date exclusions
+BENCHMARK_CONFIG = {
+    "case_csv": "input_cases",
+    "match_csv": "input_controls",
+    "matches_per_case": 10,
+    "min_matches_per_case": 1,
+    "match_variables": {
+        "sex": "category",
+        "age": 1,
+        "practice_id": "category",
+    },
+    "closest_match_variables": ["age"],
+    "date_exclusion_variables": {
+        "died_date": "before",
+        "dereg_date": "before",
+    },
+    "index_date_variable": "indexdate",
+    "replace_match_index_date_with_case": "no_offset",
+}
+
+## Options passed to match() for each engine that is timed. All are checked
+## against the frozen baseline match() of match_baseline, run as BASELINE.
+DEFAULT_ENGINES = {
+    "reference": {"engine": "reference"},
+    "partitioned": {"engine": "partitioned"},
+    "partitioned_matching_columns": {
+        "engine": "partitioned",
+        "import_columns": "matching",
+    },
+    "partitioned_workers": {"engine": "partitioned", "workers": 4},
+}
+BASELINE = "baseline"
+
+## Practice list sizes are roughly log-normal, with a median of about 8,000
+## registered patients
+PRACTICE_MEDIAN_SIZE = 8000
+PRACTICE_SIZE_SIGMA = 0.6
+PATIENTS_PER_STP = 1500000
+
+
+def get_practice_sizes(num_patients, rng):
+    """
+    Returns a relative size for each practice, enough practices for
+    num_patients at a realistic spread of list sizes.
+    """
+    num_practices = max(1, int(round(num_patients / PRACTICE_MEDIAN_SIZE / 1.2)))
+    sizes = rng.lognormal(
+        np.log(PRACTICE_MEDIAN_SIZE), PRACTICE_SIZE_SIGMA, num_practices
+    )
+    return np.clip(sizes, 500, 60000)
+
+
+def random_dates(rng, size, earliest, latest, missing_fraction=0.0):
+    """
+    Returns dates as YYYY-MM-DD strings, uniformly between earliest and
+    latest, with missing_fraction of them empty.
+    """
+    earliest = np.datetime64(earliest, "D")
+    days = (np.datetime64(latest, "D") - earliest).astype(int)
+    dates = (earliest + rng.integers(0, days + 1, size)).astype(str).astype(object)
+    dates[rng.random(size) < missing_fraction] = ""
+    return dates
+
+
+def generate_population(num_patients, first_patient_id, practice_sizes, rng, cases):
+    """
+    Generates a table like the cohortextractor output used for matching, for
+    num_patients patients with consecutive patient_ids from first_patient_id,
+    registered at practices in proportion to practice_sizes. Cases (people
+    with AF) are older than the general population.
+    """
+    num_practices = len(practice_sizes)
+    practice_id = rng.choice(
+        num_practices, size=num_patients, p=practice_sizes / practice_sizes.sum()
+    )
+    if cases:
+        age = np.clip(rng.normal(76, 10, num_patients), 18, 105)
+    else:
+        age = np.clip(rng.gamma(4, 12, num_patients) + 18, 18, 105)
+    num_stps = max(1, -(-num_practices * PRACTICE_MEDIAN_SIZE // PATIENTS_PER_STP))
+    return pd.DataFrame(
+        {
+            "patient_id": np.arange(first_patient_id, first_patient_id + num_patients),
+            "sex": rng.choice(np.array(["F", "M"]), num_patients),
+            "age": age.astype(int),
+            "practice_id": practice_id,
+            "stp": np.char.add("E", (practice_id % num_stps).astype(str)),
+            "died_date": random_dates(
+                rng, num_patients, "2019-01-01", "2021-02-01", 0.98
+            ),
+            "dereg_date": random_dates(
+                rng, num_patients, "2019-01-01", "2020-12-01", 0.95
+            ),
+            "indexdate": random_dates(rng, num_patients, "2020-03-01", "2020-12-31"),
+            "af": random_dates(
+                rng, num_patients, "2000-01-01", "2020-03-01", 0.0 if cases else 1.0
+            ),
+        }
+    )
+
+
+def generate_csvs(num_controls, num_cases, output_path, seed=1, practice_sizes=None):
+    """
+    Writes input_cases.csv and input_controls.csv to output_path, with
+    num_cases and num_controls patients in the same practices, of the given
+    relative practice_sizes or of realistic sizes. Unlike the dummy data, the
+    patient_ids of cases and controls do not overlap.
+    """
+    rng = np.random.default_rng(seed)
+    if practice_sizes is None:
+        practice_sizes = get_practice_sizes(num_controls, rng)
+    os.makedirs(output_path, exist_ok=True)
+    cases = generate_population(num_cases, 1, practice_sizes, rng, cases=True)
+    cases.to_csv(os.path.join(output_path, "input_cases.csv"), index=False)
+    controls = generate_population(
+        num_controls, num_cases + 1, practice_sizes, rng, cases=False
+    )
+    controls.to_csv(os.path.join(output_path, "input_controls.csv"), index=False)
+
+
+def same_outputs(output_path, suffix, other_suffix):
+    """
+    Checks that two runs of match() saved exactly the same matched csvs.
+    """
+    return all(
+        filecmp.cmp(
+            os.path.join(output_path, f"{name}{suffix}.csv"),
+            os.path.join(output_path, f"{name}{other_suffix}.csv"),
+            shallow=False,
+        )
+        for name in ("matched_cases", "matched_matches", "matched_combined")
+    )
+
+
+def run_baseline(output_path, suffix):
+    """
+    Runs the frozen baseline match() of match_baseline with BENCHMARK_CONFIG.
+    As it saves no metrics, returns its total time and the numbers of cases
+    and matches it matched.
+    """
+    started = time.perf_counter()
+    baseline_match(**BENCHMARK_CONFIG, output_suffix=suffix, output_path=output_path)
+    total_seconds = time.perf_counter() - started
+    matched = {
+        name: len(
+            pd.read_csv(os.path.join(output_path, f"{name}{suffix}.csv"), usecols=[0])
+        )
+        for name in ("matched_cases", "matched_matches")
+    }
+    return {"total_seconds": total_seconds, **matched}
+
+
+def check_optimal_assignment(
+    num_controls=30000,
+    num_cases=3000,
+    matches_per_case=10,
+    min_matches_per_case=8,
+    output_path="output/match_benchmark/optimal_check",
+    seed=3,
+):
+    """
+    Checks that assignment="optimal" matches at least as many cases as
+    greedy assignment in one crowded practice, where too few matches for
+    min_matches_per_case each make optimal assignment leave cases out.
+    Returns the number of cases matched by each.
+    """
+    generate_csvs(num_controls, num_cases, output_path, seed, np.array([1.0]))
+    matched_cases = {}
+    for assignment in ("greedy", "optimal"):
+        match(
+            **{
+                **BENCHMARK_CONFIG,
+                "matches_per_case": matches_per_case,
+                "min_matches_per_case": min_matches_per_case,
+            },
+            assignment=assignment,
+            output_suffix=f"_{assignment}",
+            output_path=output_path,
+        )
+        with open(
+            os.path.join(output_path, f"matching_metrics_{assignment}.json")
+        ) as f:
+            matched_cases[assignment] = json.load(f)["matched_cases"]
+    if matched_cases["optimal"] < matched_cases["greedy"]:
+        raise Exception(
+            f"Optimal assignment matched {matched_cases['optimal']} cases, "
+            f"fewer than the {matched_cases['greedy']} of greedy assignment"
+        )
+    return matched_cases
+
+
+def run_benchmark(
+    sizes=DEFAULT_SIZES,
+    case_fraction=0.02,
+    output_path="output/match_benchmark",
+    engines=DEFAULT_ENGINES,
+    reference_limit=100000,
+    seed=1,
+):
+    """
+    For each number of controls in sizes, generates cases and controls with
+    generate_csvs and runs match() with each of the engines, timing each phase
+    from its metrics file. Each engine's matched csvs are checked against
+    those of the frozen baseline match() (see match_baseline), or where it is
+    not run (above reference_limit controls, as it is too slow, as is the
+    reference engine) against the first engine that was. Saves the results to
+    benchmark_results.csv in output_path and returns them.
+    """
+    results = []
+    for num_controls in sizes:
+        num_cases = max(1, int(num_controls * case_fraction))
+        size_path = os.path.join(output_path, f"controls_{num_controls}")
+        generate_csvs(num_controls, num_cases, size_path, seed)
+
+        checked_against = None
+        if num_controls <= reference_limit:
+            checked_against = BASELINE
+            results.append(
+                {
+                    "controls": num_controls,
+                    "cases": num_cases,
+                    "engine": BASELINE,
+                    **run_baseline(size_path, f"_{BASELINE}"),
+                    "checked_against": BASELINE,
+                    "same_result": True,
+                }
+            )
+        for name, options in engines.items():
+            if options.get("engine") == "reference" and num_controls > reference_limit:
+                continue
+            match(
+                **BENCHMARK_CONFIG,
+                **options,
+                output_suffix=f"_{name}",
+                output_path=size_path,
+            )
+            with open(os.path.join(size_path, f"matching_metrics_{name}.json")) as f:
+                metrics = json.load(f)
+            if checked_against is None:
+                checked_against = name
+            results.append(
+                {
+                    "controls": num_controls,
+                    "cases": num_cases,
+                    "engine": name,
+                    **{
+                        f"{phase}_seconds": seconds
+                        for phase, seconds in metrics["phase_seconds"].items()
+                    },
+                    "total_seconds": metrics["total_seconds"],
+                    "matched_cases": metrics["matched_cases"],
+                    "matched_matches": metrics["matched_matches"],
+                    "checked_against": checked_against,
+                    "same_result": same_outputs(
+                        size_path, f"_{name}", f"_{checked_against}"
+                    ),
+                }
+            )
+
+    results = pd.DataFrame(results)
+    results.to_csv(os.path.join(output_path, "benchmark_results.csv"), index=False)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Times match() on generated data of increasing size"
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--case-fraction", type=float, default=0.02)
+    parser.add_argument("--output-path", default="output/match_benchmark")
+    parser.add_argument("--reference-limit", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--check-optimal",
+        action="store_true",
+        help="Also check that optimal assignment matches no fewer cases",
+    )
+    args = parser.parse_args()
+
+    engines = dict(DEFAULT_ENGINES)
+    engines["partitioned_workers"] = {"engine": "partitioned", "workers": args.workers}
+    results = run_benchmark(
+        args.sizes,
+        args.case_fraction,
+        args.output_path,
+        engines,
+        args.reference_limit,
+        args.seed,
+    )
+    print(results.to_string(index=False))
+    if not results["same_result"].all():
+        raise Exception("Some engines did not give the same result as the baseline")
+    if args.check_optimal:
+        print(
+            check_optimal_assignment(
+                output_path=os.path.join(args.output_path, "optimal_check")
+            )
+        )
@@ -0,0 +1,320 @@
+import os
+import bz2
+import gzip
+import json
+import lzma
+import numpy as np
+import pandas as pd
+
+## Compressed csvs: the function to open the file with, and its extension
+CSV_COMPRESSION = {
+    "gzip": (gzip.open, ".gz"),
+    "bz2": (bz2.open, ".bz2"),
+    "xz": (lzma.open, ".xz"),
+}
+
+## File extension of each output format
+OUTPUT_EXTENSIONS = {"csv": ".csv", "parquet": ".parquet", "feather": ".feather"}
+
+## Rows converted at a time when writing the combined table as parquet or
+## feather
+OUTPUT_CHUNK_SIZE = 100000
+
+
+def get_output_file(output_path, name, output_format="csv", compression=None):
+    """
+    Returns the path that a table is saved to by write_table.
+    """
+    if output_format not in OUTPUT_EXTENSIONS:
+        raise Exception(f"Output format '{output_format}' not implemented")
+    path = os.path.join(output_path, name + OUTPUT_EXTENSIONS[output_format])
+    if output_format == "csv" and compression is not None:
+        if compression not in CSV_COMPRESSION:
+            raise Exception(f"Compression '{compression}' not implemented for csv")
+        path += CSV_COMPRESSION[compression][1]
+    return path
+
+
+def open_csv(path, compression=None):
+    """
+    Opens a csv file for writing, compressing it if compression is given.
+    """
+    if compression is None:
+        return open(path, "w", newline="", encoding="utf-8")
+    return CSV_COMPRESSION[compression][0](path, "wt", newline="", encoding="utf-8")
+
+
+def import_pyarrow():
+    """
+    Imports pyarrow, which is only needed to save parquet or feather files.
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("Saving as parquet or feather needs pyarrow to be installed")
+    return pyarrow
+
+
+def get_combined_columns(tables):
+    """
+    Returns the columns, and their dtypes, that the tables would have if they
+    were concatenated (as DataFrame.append did), without concatenating them.
+    """
+    dtypes = pd.concat([table.iloc[:1] for table in tables]).dtypes
+    return dtypes.index, dtypes
+
+
+def conform(table, columns, dtypes):
+    """
+    Lays out (part of) one of the tables of get_combined_columns as it would
+    be in their concatenation.
+    """
+    table = table.reindex(columns=columns)
+    changed = {
+        column: dtype
+        for column, dtype in dtypes.items()
+        if table[column].dtype != dtype
+    }
+    return table.astype(changed) if changed else table
+
+
+def get_csv_chunksize(columns):
+    """
+    Returns the number of rows that DataFrame.to_csv formats at a time, which
+    the combined csv is written in so that it is formatted in the same way.
+    """
+    return (100000 // (len(columns) or 1)) or 1
+
+
+def iterate_combined(tables, chunksize):
+    """
+    Yields the rows of the concatenation of the tables in chunks of chunksize
+    rows, each laid out as by conform, without making the concatenation. A
+    chunk can span two tables.
+    """
+    columns, dtypes = get_combined_columns(tables)
+    pieces = []
+    num_rows = 0
+    for table in tables:
+        start = 0
+        while start < len(table):
+            end = min(start + chunksize - num_rows, len(table))
+            pieces.append(conform(table.iloc[start:end], columns, dtypes))
+            num_rows += end - start
+            start = end
+            if num_rows == chunksize:
+                yield pd.concat(pieces) if len(pieces) > 1 else pieces[0]
+                pieces = []
+                num_rows = 0
+    if num_rows > 0:
+        yield pd.concat(pieces) if len(pieces) > 1 else pieces[0]
+    elif sum(len(table) for table in tables) == 0:
+        ## So that the header is still written
+        yield conform(tables[0], columns, dtypes)
+
+
+def write_table(table, path, output_format="csv", compression=None):
+    """
+    Saves a table, with its index, as csv, parquet or feather.
+    """
+    if output_format == "csv":
+        with open_csv(path, compression) as f:
+            table.to_csv(f)
+    elif output_format == "parquet":
+        import_pyarrow()
+        table.to_parquet(path, compression=compression or "snappy")
+    elif output_format == "feather":
+        import_pyarrow()
+        table.reset_index().to_feather(path, compression=compression)
+    else:
+        raise Exception(f"Output format '{output_format}' not implemented")
+
+
+def write_combined(tables, path, output_format="csv", compression=None):
+    """
+    Saves the concatenation of the tables as write_table would, but writing
+    them a chunk at a time rather than making a combined copy of them.
+    """
+    if output_format == "csv":
+        columns, _ = get_combined_columns(tables)
+        with open_csv(path, compression) as f:
+            for number, chunk in enumerate(
+                iterate_combined(tables, get_csv_chunksize(columns))
+            ):
+                chunk.to_csv(f, header=number == 0)
+        return
+
+    pyarrow = import_pyarrow()
+
+    def arrow_chunks():
+        for chunk in iterate_combined(tables, OUTPUT_CHUNK_SIZE):
+            if output_format == "feather":
+                chunk = chunk.reset_index()
+            yield chunk
+
+    ## Columns that are all missing in some chunks take the type of the others,
+    ## so the types are found in a first pass before any chunk is written
+    schema = pyarrow.unify_schemas(
+        [
+            pyarrow.Schema.from_pandas(chunk, preserve_index=output_format == "parquet")
+            for chunk in arrow_chunks()
+        ]
+    )
+    if output_format == "parquet":
+        writer = pyarrow.parquet.ParquetWriter(
+            path, schema, compression=compression or "snappy"
+        )
+    elif output_format == "feather":
+        writer = pyarrow.ipc.new_file(
+            path, schema, options=pyarrow.ipc.IpcWriteOptions(compression=compression)
+        )
+    else:
+        raise Exception(f"Output format '{output_format}' not implemented")
+    with writer:
+        for chunk in arrow_chunks():
+            writer.write_table(
+                pyarrow.Table.from_pandas(
+                    chunk, schema=schema, preserve_index=output_format == "parquet"
+                )
+            )
+
+
+def get_shard_numbers(keys, num_shards):
+    """
+    Returns the shard, from 0 to num_shards - 1, of each of keys, so that all
+    rows with the same key are in the same shard. Keys with a whole number
+    value, whether stored as integers, floats (as when a column has missing
+    values), text or categories, go to that number modulo num_shards. Other
+    keys, including missing ones, go to pd.util.hash_array of their text
+    modulo num_shards.
+    """
+    keys = np.asarray(keys)
+    if keys.dtype.kind in "iu":
+        return keys % num_shards
+    keys = pd.Series(keys.astype(object))
+    numeric = pd.to_numeric(keys, errors="coerce").to_numpy(dtype=np.float64)
+    whole = np.isfinite(numeric) & (numeric == np.floor(numeric))
+    numbers = np.empty(len(keys), dtype=np.int64)
+    numbers[whole] = numeric[whole].astype(np.int64) % num_shards
+    text = keys[~whole].map(lambda key: "" if pd.isna(key) else str(key))
+    numbers[~whole] = pd.util.hash_array(text.to_numpy(dtype=object)) % num_shards
+    return numbers
+
+
+def split_into_shards(table, shard_by, num_shards):
+    """
+    Returns table split into num_shards tables by the shard of their
+    shard_by column, see get_shard_numbers, keeping the order of the rows.
+    """
+    if shard_by not in table.columns:
+        raise Exception(f"Cannot shard the outputs by '{shard_by}', not a column")
+    numbers = get_shard_numbers(table[shard_by], num_shards)
+    order = np.argsort(numbers, kind="stable")
+    bounds = np.searchsorted(numbers[order], np.arange(num_shards + 1))
+    return [table.iloc[order[bounds[i] : bounds[i + 1]]] for i in range(num_shards)]
+
+
+def get_shard_paths(manifest_path, name="matched_combined", keys=None):
+    """
+    Returns the paths of the name files listed in a manifest saved by
+    write_matched_outputs, or only of the shards holding keys if given.
+    """
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    shards = manifest["shards"]
+    if keys is not None:
+        numbers = set(get_shard_numbers(keys, manifest["num_shards"]).tolist())
+        shards = [shard for shard in shards if shard["shard"] in numbers]
+    output_path = os.path.dirname(manifest_path)
+    return [os.path.join(output_path, shard["files"][name]) for shard in shards]
+
+
+def write_matched_outputs(
+    matched_cases,
+    matched_matches,
+    output_path,
+    output_suffix="",
+    output_format="csv",
+    combined_output=True,
+    compression=None,
+    shards=None,
+    shard_by="set_id",
+):
+    """
+    Saves matched_cases{output_suffix}, matched_matches{output_suffix} and,
+    if combined_output, matched_combined{output_suffix} (the cases followed by
+    the matches) to output_path in output_format ("csv", "parquet" or
+    "feather"), compressed with compression if given. For csvs this can be
+    "gzip", "bz2" or "xz", and for parquet and feather any codec pyarrow
+    supports. Returns the paths of the saved files.
+    With shards, each file is instead saved as that many shards, split by
+    the shard_by column (see get_shard_numbers), with the shard number after
+    output_suffix. set_id keeps each matched set in one shard, as does
+    practice_id when it is matched on exactly. The shards are listed, with
+    their number of rows, in matched_manifest{output_suffix}.json.
+    """
+    if shards is not None:
+        width = len(str(shards - 1))
+        manifest = {
+            "shard_by": shard_by,
+            "num_shards": shards,
+            "output_format": output_format,
+            "compression": compression,
+            "shards": [],
+        }
+        paths = []
+        for number, (shard_cases, shard_matches) in enumerate(
+            zip(
+                split_into_shards(matched_cases, shard_by, shards),
+                split_into_shards(matched_matches, shard_by, shards),
+            )
+        ):
+            shard_paths = write_matched_outputs(
+                shard_cases,
+                shard_matches,
+                output_path,
+                f"{output_suffix}_shard{number:0{width}d}",
+                output_format,
+                combined_output,
+                compression,
+            )
+            names = ["matched_cases", "matched_matches", "matched_combined"]
+            rows = [len(shard_cases), len(shard_matches)]
+            rows.append(rows[0] + rows[1])
+            manifest["shards"].append(
+                {
+                    "shard": number,
+                    "files": {
+                        name: os.path.basename(path)
+                        for name, path in zip(names, shard_paths)
+                    },
+                    "rows": dict(zip(names, rows[: len(shard_paths)])),
+                }
+            )
+            paths.extend(shard_paths)
+        path = os.path.join(output_path, f"matched_manifest{output_suffix}.json")
+        with open(path, "w") as f:
+            json.dump(manifest, f, indent=2)
+        paths.append(path)
+        return paths
+
+    paths = []
+    for name, table in (
+        ("matched_cases", matched_cases),
+        ("matched_matches", matched_matches),
+    ):
+        path = get_output_file(
+            output_path, f"{name}{output_suffix}", output_format, compression
+        )
+        write_table(table, path, output_format, compression)
+        paths.append(path)
+    if combined_output:
+        path = get_output_file(
+            output_path, f"matched_combined{output_suffix}", output_format, compression
+        )
+        write_combined(
+            [matched_cases, matched_matches], path, output_format, compression
+        )
+        paths.append(path)
+    return paths
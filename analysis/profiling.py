@@ -0,0 +1,111 @@
+import json
+import math
+import time
+import heapq
+from contextlib import contextmanager, nullcontext
+
+## Number of slowest cases kept by a Profiler
+SLOWEST_CASES = 20
+
+
+class Profiler:
+    """
+    Records, for profile=True in match(), the cumulative time and number of
+    calls of each section of the matching loop, a histogram of the time taken
+    per case (in power of two bins of microseconds), and the slowest cases
+    with their partition and the size of their eligible pool: the matches
+    left once those already matched and those excluded by the match
+    variables and date exclusions are left out.
+    Section times are inclusive, so a section called within another is
+    counted in both.
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.histogram = {}
+        self.slowest = []
+        self.cases = 0
+
+    @contextmanager
+    def section(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = (
+                self.seconds.get(name, 0.0) + time.perf_counter() - started
+            )
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def record_case(self, case_position, partition, pool_size, seconds):
+        self.cases += 1
+        microseconds = seconds * 1e6
+        bin_start = 2 ** int(math.log2(microseconds)) if microseconds >= 1 else 0
+        self.histogram[bin_start] = self.histogram.get(bin_start, 0) + 1
+        case = (seconds, int(case_position), int(partition), int(pool_size))
+        if len(self.slowest) < SLOWEST_CASES:
+            heapq.heappush(self.slowest, case)
+        else:
+            heapq.heappushpop(self.slowest, case)
+
+    def merge(self, other):
+        """
+        Adds in the records of another Profiler, such as one from a worker.
+        """
+        for name, seconds in other.seconds.items():
+            self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+            self.calls[name] = self.calls.get(name, 0) + other.calls[name]
+        for bin_start, count in other.histogram.items():
+            self.histogram[bin_start] = self.histogram.get(bin_start, 0) + count
+        for case in other.slowest:
+            if len(self.slowest) < SLOWEST_CASES:
+                heapq.heappush(self.slowest, case)
+            else:
+                heapq.heappushpop(self.slowest, case)
+        self.cases += other.cases
+
+    def summary(self, describe_case=None):
+        """
+        Returns the records as a dict. describe_case, given a case position,
+        returns a description of its partition for the slowest cases.
+        """
+        slowest = []
+        for seconds, case_position, partition, pool_size in sorted(
+            self.slowest, reverse=True
+        ):
+            case = {
+                "case_position": case_position,
+                "seconds": seconds,
+                "partition": partition,
+                "pool_size": pool_size,
+            }
+            if describe_case is not None:
+                case["partition_values"] = describe_case(case_position)
+            slowest.append(case)
+        return {
+            "cases": self.cases,
+            "sections": {
+                name: {"seconds": self.seconds[name], "calls": self.calls[name]}
+                for name in sorted(self.seconds, key=self.seconds.get, reverse=True)
+            },
+            "case_microseconds_histogram": {
+                f"{bin_start}-{max(2 * bin_start, 1)}": self.histogram[bin_start]
+                for bin_start in sorted(self.histogram)
+            },
+            "slowest_cases": slowest,
+        }
+
+    def save(self, profile_path, describe_case=None):
+        with open(profile_path, "w") as f:
+            json.dump(self.summary(describe_case), f, indent=2)
+
+
+def profile_section(profiler, name):
+    """
+    Returns profiler.section(name), or a context that does nothing if there
+    is no profiler.
+    """
+    if profiler is None:
+        return nullcontext()
+    return profiler.section(name)
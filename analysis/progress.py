@@ -0,0 +1,86 @@
+import json
+import time
+from datetime import datetime, timedelta
+
+
+class PhaseTimer:
+    """
+    Records how long each phase of matching takes. Each call to end_phase
+    adds the time since the previous call (or since the timer was started) to
+    the named phase.
+    """
+
+    def __init__(self):
+        self.started = datetime.now()
+        self.last = time.perf_counter()
+        self.durations = {}
+
+    def end_phase(self, name):
+        now = time.perf_counter()
+        self.durations[name] = self.durations.get(name, 0.0) + now - self.last
+        self.last = now
+        return self.durations[name]
+
+    def save(self, metrics_path, **metrics):
+        """
+        Writes the phase durations, in seconds, and any other metrics to
+        metrics_path as JSON.
+        """
+        with open(metrics_path, "w") as f:
+            json.dump(
+                {
+                    "started": self.started.isoformat(),
+                    "phase_seconds": self.durations,
+                    "total_seconds": sum(self.durations.values()),
+                    **metrics,
+                },
+                f,
+                indent=2,
+                default=str,
+            )
+
+
+class ProgressReporter:
+    """
+    Counts the cases matched and, at most every interval seconds, writes a
+    progress line with the number of cases done, the rate over the last
+    interval, the time left at that rate, and the partition of the current
+    case (from describe_case, given its position).
+    """
+
+    def __init__(self, total, report, describe_case=None, interval=60):
+        self.total = total
+        self.report = report
+        self.describe_case = describe_case
+        self.interval = interval
+        self.last_time = time.perf_counter()
+        self.last_done = 0
+        self.done = 0
+
+    def __call__(self, case_position, count=1):
+        self.done += count
+        now = time.perf_counter()
+        if now - self.last_time < self.interval:
+            return
+        rate = (self.done - self.last_done) / (now - self.last_time)
+        if rate > 0:
+            eta = timedelta(seconds=round((self.total - self.done) / rate))
+        else:
+            eta = "unknown"
+        line = (
+            f"Matched {self.done}/{self.total} cases "
+            f"({100 * self.done / max(self.total, 1):.1f}%), "
+            f"{rate:.1f} cases/s, ETA {eta}"
+        )
+        if self.describe_case is not None:
+            line += f", partition {self.describe_case(case_position)}"
+        self.report([line])
+        self.last_time = now
+        self.last_done = self.done
+
+    def skip(self, count):
+        """
+        Counts cases that were matched before a resumed run started.
+        """
+        self.done += count
+        self.last_done += count
@@ -0,0 +1,282 @@
+import os
+import ast
+import numpy as np
+import pandas as pd
+
+## What each value of returning gives, where it is not the type of the
+## variable itself
+RETURNING_TYPES = {
+    "binary_flag": "flag",
+    "date": "date",
+    "date_of_death": "date",
+    "date_admitted": "date",
+    "date_discharged": "date",
+    "date_arrived": "date",
+    "date_deregistered": "date",
+    "number_of_matches_in_period": "count",
+    "number_of_episodes": "count",
+    "numeric_value": "float",
+    "category": "category",
+    "code": "category",
+    "primary_diagnosis": "category",
+    "stp_code": "category",
+    "msoa_code": "category",
+    "nuts1_region_name": "category",
+    "pseudo_id": "integer",
+    "index_of_multiple_deprivation": "integer",
+    "rural_urban_classification": "integer",
+}
+
+## Type of the variables of the patients functions whose type does not depend
+## on returning
+FUNCTION_TYPES = {
+    "age_as_of": "integer",
+    "sex": "category",
+    "most_recent_bmi": "float",
+    "categorised_as": "category",
+    "care_home_status_as_of": "category",
+    "date_deregistered_from_all_supported_practices": "date",
+    "satisfying": "flag",
+    "registered_as_of": "flag",
+    "registered_with_one_practice_between": "flag",
+    "with_complete_gp_consultation_history_between": "flag",
+}
+
+## Columns added by include_date_of_match, by function
+DATE_OF_MATCH_SUFFIXES = {"most_recent_bmi": "_date_measured"}
+
+## dtype each type is read as, and the dtype it is kept as (where
+## different). Integers are read as nullable, and kept as float64 if any are
+## missing, as pandas would have read them. Dates are read as text and parsed
+## after
+DTYPES = {
+    "flag": ("Int8", "int8"),
+    "count": ("Int32", "int32"),
+    "integer": ("Int32", "int32"),
+    "float": ("float64", None),
+    "category": ("category", None),
+}
+
+## cohortextractor date formats, and how they are parsed. Dates without a
+## day are kept as categories of their text
+DATE_FORMATS = {"YYYY-MM-DD": "%Y-%m-%d", "YYYY-MM": None, "YYYY": None}
+
+
+def literal(node, default=None):
+    """
+    Returns the value of a literal in the syntax tree, or default if the node
+    is missing or not a literal.
+    """
+    if node is None:
+        return default
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        return default
+
+
+def get_variable_schema(name, function_name, keywords):
+    """
+    Returns the columns that a patients.{function_name} variable called name
+    gives in the extract, each with its type and, for dates, date_format.
+    keywords are the syntax tree nodes of its keyword arguments. Returns no
+    columns for functions whose type is not known.
+    """
+    date_format = literal(keywords.get("date_format"), "YYYY")
+    if "categorised_as" in keywords:
+        variable_type = "category"
+    elif function_name in FUNCTION_TYPES:
+        variable_type = FUNCTION_TYPES[function_name]
+    else:
+        variable_type = RETURNING_TYPES.get(
+            literal(keywords.get("returning"), "binary_flag")
+        )
+    if variable_type is None:
+        return {}
+    if variable_type == "date" and date_format not in DATE_FORMATS:
+        raise Exception(f"Variable '{name}' has unknown date_format '{date_format}'")
+
+    schema = {name: {"type": variable_type}}
+    if variable_type == "date":
+        schema[name]["date_format"] = date_format
+    if literal(keywords.get("include_date_of_match")) or literal(
+        keywords.get("include_measurement_date")
+    ):
+        if literal(keywords.get("include_day")):
+            match_format = "YYYY-MM-DD"
+        elif literal(keywords.get("include_month")):
+            match_format = "YYYY-MM"
+        else:
+            match_format = "YYYY"
+        suffix = DATE_OF_MATCH_SUFFIXES.get(function_name, "_date")
+        schema[name + suffix] = {"type": "date", "date_format": match_format}
+    return schema
+
+
+def get_variables_schema(call_node, module_dir, tree):
+    """
+    Returns the schema of the variables passed as keyword arguments to a
+    StudyDefinition(...) or dict(...) call. **name arguments are looked up in
+    tree, or in the module name is imported from in module_dir.
+    """
+    schema = {}
+    for keyword in call_node.keywords:
+        if keyword.arg is None:
+            schema.update(find_variables(keyword.value.id, module_dir, tree))
+            continue
+        if keyword.arg in ("population", "default_expectations", "index_date"):
+            continue
+        value = keyword.value
+        if (
+            isinstance(value, ast.Call)
+            and isinstance(value.func, ast.Attribute)
+            and isinstance(value.func.value, ast.Name)
+            and value.func.value.id == "patients"
+        ):
+            keywords = {
+                argument.arg: argument.value
+                for argument in value.keywords
+                if argument.arg is not None
+            }
+            schema.update(get_variable_schema(keyword.arg, value.func.attr, keywords))
+    return schema
+
+
+def find_variables(name, module_dir, tree):
+    """
+    Returns the schema of the dict of variables called name, defined in tree
+    or imported into it from a module in module_dir.
+    """
+    for node in tree.body:
+        if (
+            isinstance(node, ast.Assign)
+            and any(
+                isinstance(target, ast.Name) and target.id == name
+                for target in node.targets
+            )
+            and isinstance(node.value, ast.Call)
+        ):
+            return get_variables_schema(node.value, module_dir, tree)
+        if isinstance(node, ast.ImportFrom) and any(
+            (alias.asname or alias.name) == name for alias in node.names
+        ):
+            module_path = os.path.join(module_dir, f"{node.module}.py")
+            with open(module_path) as f:
+                module_tree = ast.parse(f.read(), module_path)
+            imported_name = [
+                alias.name
+                for alias in node.names
+                if (alias.asname or alias.name) == name
+            ][0]
+            return find_variables(imported_name, module_dir, module_tree)
+    raise Exception(f"Could not find the variables '{name}'")
+
+
+def extract_schema(study_definition_path):
+    """
+    Returns the schema of the csv that a study definition extracts: a dict
+    mapping each column to a dict with its type ("flag", "count", "integer",
+    "float", "category" or "date") and, for dates, its date_format. It is read
+    from the source of the study definition (and the modules its variables
+    are imported from), so cohortextractor does not need to be installed.
+    Variables of unknown functions are left out, and are read as pandas
+    infers them.
+    """
+    with open(study_definition_path) as f:
+        tree = ast.parse(f.read(), study_definition_path)
+    module_dir = os.path.dirname(os.path.abspath(study_definition_path))
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Name)
+            and node.func.id == "StudyDefinition"
+        ):
+            return get_variables_schema(node, module_dir, tree)
+    raise Exception(f"No StudyDefinition found in {study_definition_path}")
+
+
+def get_schema(schema):
+    """
+    Returns schema, or the schema extracted from it if it is the path of a
+    study definition.
+    """
+    if isinstance(schema, str):
+        return extract_schema(schema)
+    return schema
+
+
+def get_schema_dtypes(schema, columns=None):
+    """
+    Returns the dtype each column of the schema (or only of columns) is read
+    as, for pd.read_csv. Dates with a day are read as text, to be parsed by
+    set_schema_types, and other dates as categories of their text.
+    """
+    dtypes = {}
+    for column, column_schema in schema.items():
+        if columns is not None and column not in columns:
+            continue
+        if column_schema["type"] == "date":
+            if DATE_FORMATS[column_schema["date_format"]] is None:
+                dtypes[column] = "category"
+            else:
+                dtypes[column] = "object"
+        else:
+            dtypes[column] = DTYPES[column_schema["type"]][0]
+    return dtypes
+
+
+def set_schema_types(df, schema):
+    """
+    Finishes the types of the columns of df read with get_schema_dtypes:
+    parses the dates with a day with their exact format, and makes the
+    integers plain numpy integers (or float64 if any are missing).
+    """
+    for column, column_schema in schema.items():
+        if column not in df.columns:
+            continue
+        if column_schema["type"] == "date":
+            date_format = DATE_FORMATS[column_schema["date_format"]]
+            if date_format is not None and df[column].dtype == object:
+                df[column] = pd.to_datetime(df[column], format=date_format)
+            continue
+        read_dtype, dtype = DTYPES[column_schema["type"]]
+        if dtype is not None and df[column].dtype == read_dtype:
+            if df[column].hasnans:
+                dtype = "float64"
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def read_study_csv(csv_path, schema, **read_csv_kwargs):
+    """
+    Reads a csv extracted by a study definition, with each column of the
+    schema (or the path of a study definition) read as its type: flags and
+    counts as small integers, categories as categoricals and dates with a day
+    as dates. Other arguments are passed to pd.read_csv.
+    """
+    schema = get_schema(schema)
+    header = pd.read_csv(csv_path, nrows=0).columns
+    dtype = get_schema_dtypes(schema, header)
+    dtype.update(read_csv_kwargs.pop("dtype", {}))
+    return set_schema_types(
+        pd.read_csv(csv_path, dtype=dtype, **read_csv_kwargs), schema
+    )
+
+
+def get_month_categories(values):
+    """
+    Returns the month (MM) of each YYYY-MM(-DD) value of a categorical
+    Series, as a categorical, by slicing its categories rather than every
+    value.
+    """
+    months, codes = np.unique(
+        values.cat.categories.astype(str).str.slice(start=5, stop=7),
+        return_inverse=True,
+    )
+    value_codes = values.cat.codes.to_numpy()
+    return pd.Series(
+        pd.Categorical.from_codes(
+            np.where(value_codes >= 0, codes[value_codes], -1), months
+        ),
+        index=values.index,
+    )